@@ -6,11 +6,14 @@ from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 load_dotenv(find_dotenv())
 
-from middlewares.db import DataBaseSesssion, CheckUserSubscription
+from middlewares.db import DataBaseSesssion, CheckUserSubscription, UsageContext
 from handlers.anketa import anketa_router
 from handlers.recommendations import recommendations_router
 from database.engine import create_db, drop_db, session_maker
 from handlers.favourites import favourites_router
+from utils.http_client import init_http_session, close_http_session
+from kinopoisk_imdb.search import run_unservable_sweeper
+from utils.usage import run_usage_flusher, flush_usage
 
 
 
@@ -18,6 +21,7 @@ ALLOWED_UPDATES = ['message', 'edited_message', 'callback_query']
 
 bot  = Bot(token=os.getenv('TOKEN'), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
+background_tasks = []
 
 
 dp.include_router(anketa_router)
@@ -25,12 +29,21 @@ dp.include_router(recommendations_router)
 dp.include_router(favourites_router)
 
 async def on_startup(bot: Bot, dispatcher: Dispatcher):
-    run_param = True
+    # По умолчанию базу не сносим: в ней постоянные кэши (IMDb ID, GPT, поиск, постеры) и очередь кандидатов,
+    # а недостающие колонки старой базы добавит create_db (database/schema_upgrade.py)
+    run_param = os.getenv('DROP_DB_ON_STARTUP', 'false').lower() == 'true'
     if run_param:
         await drop_db()
     await create_db()
+    await init_http_session()
+    background_tasks.append(asyncio.create_task(run_unservable_sweeper(session_maker)))
+    background_tasks.append(asyncio.create_task(run_usage_flusher(session_maker)))
 
 async def on_shutdown(bot: Bot, dispatcher: Dispatcher):
+    for task in background_tasks:
+        task.cancel()
+    await flush_usage(session_maker)
+    await close_http_session()
     print('Бот лег...')
 
 
@@ -40,6 +53,9 @@ async def main():
 
     dp.update.middleware(DataBaseSesssion(session_pool=session_maker))
     dp.update.middleware(CheckUserSubscription(bot=bot))
+    # Внутренние middleware: им уже известен обработчик, расход внешних API пишем на него
+    dp.message.middleware(UsageContext())
+    dp.callback_query.middleware(UsageContext())
 
     await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
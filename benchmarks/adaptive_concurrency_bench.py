@@ -0,0 +1,106 @@
+"""
+Сравнение фиксированного asyncio.Semaphore(5) с AdaptiveLimiter из utils/concurrency.py
+на локальной заглушке внешнего API с переменной задержкой.
+
+Заглушка работает в три фазы: "быстрая" (много воркеров, ~50 мс), "деградация"
+(мало воркеров, ~300 мс) и снова "быстрая". Запросы сверх числа воркеров ждут в
+очереди сервера, а при сильной перегрузке сервер отвечает ошибкой (как 503).
+Ошибочные запросы клиент повторяет после короткой паузы.
+
+    python -m benchmarks.adaptive_concurrency_bench
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from utils.concurrency import AdaptiveLimiter
+
+
+class StubUpstream:
+    # (длительность фазы в секундах, воркеров, средняя задержка)
+    PHASES = [(3.0, 40, 0.05), (3.0, 4, 0.30), (3.0, 40, 0.05)]
+    OVERLOAD_FACTOR = 2  # очередь длиннее воркеров * OVERLOAD_FACTOR -> ошибка
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.in_flight = 0
+
+    def _phase(self):
+        elapsed = time.monotonic() - self.started_at
+        for duration, workers, latency in self.PHASES:
+            if elapsed < duration:
+                return workers, latency
+            elapsed -= duration
+        return self.PHASES[-1][1:]
+
+    async def call(self) -> bool:
+        workers, latency = self._phase()
+        if self.in_flight >= workers * self.OVERLOAD_FACTOR:
+            await asyncio.sleep(0.01)
+            return False
+
+        self.in_flight += 1
+        try:
+            # Сверх числа воркеров запросы стоят в очереди: задержка растёт пропорционально
+            queue_penalty = max(1.0, self.in_flight / workers)
+            await asyncio.sleep(random.lognormvariate(0, 0.3) * latency * queue_penalty)
+            return True
+        finally:
+            self.in_flight -= 1
+
+
+async def _fixed_call(upstream: StubUpstream, semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        return await upstream.call()
+
+
+async def _adaptive_call(upstream: StubUpstream, limiter: AdaptiveLimiter) -> bool:
+    async with limiter.slot() as outcome:
+        ok = await upstream.call()
+        outcome.error = not ok
+        return ok
+
+
+async def _run(call, clients: int, duration: float) -> dict:
+    stats = {'ok': 0, 'errors': 0}
+    deadline = time.monotonic() + duration
+
+    async def client():
+        while time.monotonic() < deadline:
+            if await call():
+                stats['ok'] += 1
+            else:
+                stats['errors'] += 1
+                await asyncio.sleep(0.05)
+
+    await asyncio.gather(*(client() for _ in range(clients)))
+    stats['throughput'] = stats['ok'] / duration
+    return stats
+
+
+async def main(clients: int, seed: int):
+    duration = sum(phase[0] for phase in StubUpstream.PHASES)
+
+    random.seed(seed)
+    upstream = StubUpstream()
+    semaphore = asyncio.Semaphore(5)
+    fixed = await _run(lambda: _fixed_call(upstream, semaphore), clients, duration)
+
+    random.seed(seed)
+    upstream = StubUpstream()
+    limiter = AdaptiveLimiter('bench', initial=5, max_limit=60)
+    adaptive = await _run(lambda: _adaptive_call(upstream, limiter), clients, duration)
+
+    print(f"{clients} клиентов, {duration:.0f} с, фазы заглушки: {StubUpstream.PHASES}")
+    print(f"  Semaphore(5)     успешных/с: {fixed['throughput']:.1f}, ошибок: {fixed['errors']}")
+    print(f"  AdaptiveLimiter  успешных/с: {adaptive['throughput']:.1f}, ошибок: {adaptive['errors']}, "
+          f"лимит в конце: {limiter.state()}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main(args.clients, args.seed))
@@ -0,0 +1,98 @@
+"""
+Сравнение старого подхода (новая aiohttp.ClientSession на каждый запрос)
+с общей пуловой сессией из utils/http_client.py.
+
+Моделируем одну пачку рекомендаций: 20 названий, на каждое по 2 запроса
+(OMDb + постер/Кинопоиск). По умолчанию поднимается локальная заглушка,
+которая считает новые TCP-соединения. Чтобы измерить реальные TLS- и
+DNS-рукопожатия, передайте внешний адрес:
+
+    python -m benchmarks.http_session_bench --url https://api.kinopoisk.dev/ --batches 3
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from utils.http_client import init_http_session, close_http_session, get_http_session
+
+
+TITLES_PER_BATCH = 20
+REQUESTS_PER_TITLE = 2
+
+
+async def _start_stub_server(port: int):
+    # Каждое новое TCP-соединение на стороне сервера - это отдельный transport
+    transports = set()
+
+    async def handler(request):
+        transports.add(request.transport)
+        return web.json_response({'Response': 'True', 'imdbID': 'tt0000000'})
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner, transports
+
+
+async def _request_with_fresh_session(url: str):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            await response.read()
+
+
+async def _request_with_shared_session(url: str):
+    async with get_http_session().get(url) as response:
+        await response.read()
+
+
+async def _run_batch(url: str, request_fn) -> float:
+    started = time.perf_counter()
+    tasks = [request_fn(url) for _ in range(TITLES_PER_BATCH * REQUESTS_PER_TITLE)]
+    await asyncio.gather(*tasks)
+    return time.perf_counter() - started
+
+
+async def main(url: str | None, batches: int, port: int):
+    runner, transports = None, None
+    if url is None:
+        runner, transports = await _start_stub_server(port)
+        url = f'http://127.0.0.1:{port}/'
+
+    results = {}
+    for name, request_fn in (('fresh session', _request_with_fresh_session),
+                             ('shared session', _request_with_shared_session)):
+        if name == 'shared session':
+            await init_http_session()
+        if transports is not None:
+            transports.clear()
+
+        timings = [await _run_batch(url, request_fn) for _ in range(batches)]
+        results[name] = (sum(timings) / len(timings), len(transports) if transports is not None else None)
+
+    await close_http_session()
+    if runner is not None:
+        await runner.cleanup()
+
+    print(f"Пачка: {TITLES_PER_BATCH} названий x {REQUESTS_PER_TITLE} запроса, {batches} повторов, {url}")
+    for name, (avg, conns) in results.items():
+        conns_text = f", новых соединений: {conns}" if conns is not None else ""
+        print(f"  {name:<15} среднее время пачки: {avg * 1000:.1f} мс{conns_text}")
+
+    fresh_avg = results['fresh session'][0]
+    shared_avg = results['shared session'][0]
+    print(f"  Экономия на рукопожатиях: {(fresh_avg - shared_avg) * 1000:.1f} мс на пачку")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=None, help='внешний адрес вместо локальной заглушки')
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    asyncio.run(main(args.url, args.batches, args.port))
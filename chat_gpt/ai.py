@@ -1,4 +1,4 @@
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 from dotenv import load_dotenv
 from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram.fsm.context import FSMContext
@@ -6,93 +6,298 @@ from aiogram.fsm.context import FSMContext
 
 import os
 import logging
-import re
+import json
+import asyncio
+from contextlib import asynccontextmanager
 
 
-from chat_gpt.questions import questions
-from database.orm_query import get_user_preferences, get_movies_by_interaction
+from chat_gpt.questions import questions, QUESTION_KEYS
+from chat_gpt.anketa_mask import answers_key, answers_text
+from chat_gpt.movie_output import MOVIES_RESPONSE_FORMAT, MOVIES_FORMAT_INSTRUCTION, JsonTitleStream, parse_movie_recommendations, parse_stats, format_movie
+from chat_gpt.model_router import ModelRoute, INTERACTIVE_ROUTE, models_state
+from chat_gpt.recommendation_cache import recommendation_cache, prompt_key, MIN_UNSEEN_TITLES
+from database.orm_query import get_user_preferences, get_movies_by_interaction, get_candidate_pool, get_recent_seen_movies, get_omdb_titles
+from utils.rate_limiter import get_limiter, parse_retry_after, QuotaExceededError
+from utils.circuit_breaker import get_breaker
+from utils.usage import usage_tracker
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-client = AsyncOpenAI(api_key=os.getenv('CHATGPT_API_KEY'))
-
-def extract_movies_from_gpt_response(response_text: str) -> list[str]:
-    pattern = r"Movies\s*=\s*\[\s*(.*?)\s*\]"
-    match = re.search(pattern, response_text, re.DOTALL)
-    if not match:
-        logger.warning(f"Pattern not found in GPT response: {response_text}")
-        return []
-
-    movies_string = match.group(1)
-    return [movie.strip().strip('"').strip("'") for movie in re.split(r',\s*', movies_string)]
-
+# Повторы делаем сами через ограничитель, чтобы учитывать общий Retry-After для всех запросов
+client = AsyncOpenAI(api_key=os.getenv('CHATGPT_API_KEY'), max_retries=0)
+openai_limiter = get_limiter('openai')
+
+
+openai_breaker = get_breaker('openai')
+
+
+@asynccontextmanager
+async def _openai_call():
+    # Исчерпан бюджет токенов или разомкнут предохранитель - сразу бросаем ошибку, обработчики уйдут в локальный каталог
+    usage_tracker.check('openai')
+    openai_breaker.check()
+    try:
+        yield
+    except asyncio.CancelledError:
+        openai_breaker.record_skipped()  # запрос отменил роутер моделей - о здоровье сервиса это ничего не говорит
+        raise
+    except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError):
+        openai_breaker.record_failure()
+        raise
+    except QuotaExceededError:
+        openai_breaker.record_skipped()
+        raise
+    except Exception:
+        openai_breaker.record_success()  # сервис ответил, ошибка в самом запросе
+        raise
+    openai_breaker.record_success()
+
+
+def _record_openai_usage(usage, content: str):
+    # Вызовы и ошибки считает _create_with_retries, здесь - только расход токенов и объём ответа
+    tokens = getattr(usage, 'total_tokens', 0) or 0
+    usage_tracker.record('openai', calls=0, tokens=tokens, bytes=len((content or '').encode('utf-8')))
+
+
+async def create_chat_completion(**kwargs):
+    async with _openai_call():
+        response = await _create_with_retries(**kwargs)
+    _record_openai_usage(response.usage, response.choices[0].message.content)
+    return response
+
+
+async def stream_chat_completion(on_title=None, **kwargs) -> tuple[str, object]:
+    """
+    Потоковый ответ GPT: как только в JSON-ответе закрывается очередное значение "title",
+    вызывается on_title(title). Возвращает полный текст ответа и расход токенов
+    """
+    parser = JsonTitleStream()
+    parts = []
+    usage = None
+    async with _openai_call():
+        # Повторяем только установку соединения: оборванный на середине поток бросает ошибку
+        stream = await _create_with_retries(stream=True, stream_options={'include_usage': True}, **kwargs)
+        async for chunk in stream:
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage  # последний кусок потока: только usage, без choices
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+            if on_title:
+                for title in parser.feed(delta):
+                    on_title(title)
+    content = ''.join(parts)
+    _record_openai_usage(usage, content)
+    return content, usage
+
+
+SEEN_INTERACTIONS = ['liked', 'disliked', 'skipped', 'watched']
+# Сколько токенов запроса можно потратить на список исключений; env GPT_EXCLUSION_TOKEN_BUDGET
+EXCLUSION_TOKEN_BUDGET = int(os.getenv('GPT_EXCLUSION_TOKEN_BUDGET', 300))
+
+
+async def get_seen_imdb_ids(user_id: int, session: AsyncSession) -> set:
+    movies = await get_movies_by_interaction(
+        user_id=user_id, session=session,
+        interaction_types=SEEN_INTERACTIONS
+    )
+    return {movie.imdb for movie in movies}
+
+
+def estimate_tokens(text: str) -> int:
+    # Грубая оценка без токенизатора: ~4 символа латиницы на токен, кириллица дороже
+    return sum(2 if ord(char) > 127 else 1 for char in text) // 4 + 1
+
+
+class ExclusionList:
+    """
+    Что GPT не должен предлагать: названия, которые не удалось показать в прошлых попытках,
+    и последние просмотренные фильмы. В запрос попадает столько, сколько влезает в token_budget
+    """
+
+    def __init__(self, failed: list[str] = (), seen: list[str] = (), token_budget: int = EXCLUSION_TOKEN_BUDGET):
+        self.failed = list(failed)
+        self.seen = list(seen)
+        self.token_budget = token_budget
+
+    def prompt_note(self) -> str:
+        header = "Do not recommend any of these movies (already seen or unavailable): "
+        used = estimate_tokens(header)
+        picked, known = [], set()
+        # Сначала неудачные названия текущей серии запросов, затем просмотренное - от свежего к старому
+        for title in self.failed + self.seen:
+            key = title.casefold()
+            if key in known:
+                continue
+            cost = estimate_tokens(title) + 1
+            if used + cost > self.token_budget:
+                break
+            picked.append(title)
+            known.add(key)
+            used += cost
+
+        if not picked:
+            return ''
+        return header + '; '.join(picked)
+
+
+async def build_exclusions(user_id: int, session: AsyncSession, failed_titles: list[str] = ()) -> ExclusionList:
+    recent = await get_recent_seen_movies(user_id, session, SEEN_INTERACTIONS)
+    # GPT отвечает по-английски, поэтому предпочитаем английское название из OMDb, иначе - название с Кинопоиска
+    english = await get_omdb_titles([row.imdb for row in recent], session)
+    seen = [english.get(row.imdb) or f"{row.movie_name} ({row.movie_year})" for row in recent]
+    return ExclusionList(failed=failed_titles, seen=seen)
+
+
+async def _complete_movie_request(model: str, messages: list, on_title=None) -> tuple[str, object]:
+    if on_title is None:
+        response = await create_chat_completion(messages=messages, model=model, response_format=MOVIES_RESPONSE_FORMAT)
+        return response.choices[0].message.content, response.usage
+    return await stream_chat_completion(on_title, messages=messages, model=model, response_format=MOVIES_RESPONSE_FORMAT)
+
+
+async def request_movie_titles(messages: list, on_title=None, route: ModelRoute = INTERACTIVE_ROUTE,
+                               seen_imdb_ids: set | None = None, exclusions: ExclusionList | None = None) -> list[str]:
+    """
+    Запрос списка фильмов у GPT; с on_title ответ читается потоком и названия отдаются по мере генерации.
+    С seen_imdb_ids ответ кэшируется по хэшу запроса, а из кэша отдаются только непросмотренные фильмы.
+    exclusions дописывается к последнему сообщению, но в ключ кэша не входит.
+    route выбирает модель: не уложилась основная в бюджет задержки - ответ берётся у запасной.
+    После мягкого суточного бюджета токенов (utils/usage.py) сразу используется запасная модель
+    """
+    saving = usage_tracker.soft_exceeded('openai')
+    key = None
+    if seen_imdb_ids is not None:
+        key = prompt_key(route.primary, messages)
+        # В режиме экономии отдаём из кэша даже короткий остаток
+        min_unseen = 1 if saving else MIN_UNSEEN_TITLES
+        cached = await recommendation_cache.get_unseen(key, seen_imdb_ids, exclusions.failed if exclusions else (), min_unseen=min_unseen)
+        logger.info(f"Кэш рекомендаций GPT: {recommendation_cache.stats()}")
+        if cached is not None:
+            if on_title:
+                for title in cached:
+                    on_title(title)
+            return cached
+
+    note = exclusions.prompt_note() if exclusions else ''
+    if note:
+        messages = messages[:-1] + [{**messages[-1], 'content': f"{messages[-1]['content']}\n\n{note}"}]
+
+    if saving and route.fallback:
+        # Бюджет токенов на исходе: сразу идём в дешёвую модель, ключ кэша остаётся прежним
+        route = ModelRoute(route.fallback, budget=route.budget)
+    content = await route.run(lambda model: _complete_movie_request(model, messages, on_title))
+    logger.info(f"Extracted CHAT GPT data: {content}")
+    logger.info(f"Модели GPT: {models_state()}, расход: {usage_tracker.state()['openai']}")
+
+    movies = parse_movie_recommendations(content)
+    logger.info(f"Разбор ответов GPT: {parse_stats()}")
+    # Год едет вместе с названием: по нему OMDb отличит ремейк от оригинала
+    titles = [format_movie(movie) for movie in movies]
+    if key and titles:
+        await recommendation_cache.add(key, titles)
+    return titles
+
+
+async def _create_with_retries(**kwargs):
+    for attempt in range(openai_limiter.max_retries + 1):
+        await openai_limiter.acquire()
+        usage_tracker.record('openai')
+        try:
+            return await client.chat.completions.create(**kwargs)
+        except RateLimitError as e:
+            usage_tracker.record('openai', calls=0, errors=1)
+            if attempt == openai_limiter.max_retries:
+                raise
+            logger.warning(f"OpenAI ограничил запросы (429), попытка {attempt + 1}")
+            openai_limiter.penalize(parse_retry_after(e.response.headers.get('retry-after')))
+        except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+            usage_tracker.record('openai', calls=0, errors=1)
+            if attempt == openai_limiter.max_retries:
+                raise
+            logger.warning(f"Ошибка OpenAI: {e}, попытка {attempt + 1}")
+            await asyncio.sleep(openai_limiter.backoff(attempt))
+
+
+def build_preferences_messages(preferences) -> list:
+    """Запрос к GPT по анкете; preferences - Users_anketa или None"""
+    answers = answers_text(preferences) if preferences else {}
 
-async def get_movie_recommendation_by_preferences(user_id: int, session=AsyncSession):
-    preferences = await get_user_preferences(user_id, session)
-    answers = {
-        "rec1": "Ответ отсутствует",
-        "rec2": "Ответ отсутствует",
-        "rec3": "Ответ отсутствует",
-        "rec4": "Ответ отсутствует",
-        "rec5": "Ответ отсутствует",
-    
-    }
-    if preferences:
-        answers.update({
-            "rec1": preferences.mood or "Ответ отсутствует",
-            "rec2": preferences.genres or "Ответ отсутствует",
-            "rec3": preferences.era or "Ответ отсутствует",
-            "rec4": preferences.country or "Ответ отсутствует",
-            "rec5": preferences.themes or "Ответ отсутствует",
-
-        })
-    
     # Формирование текста для GPT
     text = 'Я ответил на вопросы о фильмах. Порекомендуй мне фильмы.\n'
-    for i, question in enumerate(questions):
-        answer_key = f"rec{i + 1}"  # Ключи словаря rec1, rec2 и т. д.
-        answer = answers.get(answer_key, "Ответ отсутствует")  # Берем ответ или пишем "Ответ отсутствует"
+    for i, (question_key, question) in enumerate(zip(QUESTION_KEYS, questions)):
+        answer = answers.get(question_key) or "Ответ отсутствует"
         text += f"Вопрос {i + 1}: {question}\nОтвет: {answer}\n\n"
 
-    # Отправка запроса в OpenAI
-    response = await client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are a recommendation system for selecting movies based on the user's preferences. "
-                    "Your task is to recommend movies for the user based on their preferences. "
-                    "Output 20 movies that match the user's preferences. Below are the user's answers to the preference questions in Russian, "
-                    "however, all movie titles you recommend should strictly be in English. The output data should be in the format of a Python list Movies = [], "
-                    "containing only the movie titles in English."
-                )
-            },
-            {
-                "role": "user",
-                "content": str(text)
-            }
-        ],
-        model='gpt-4o'
-    )
+    return [
+        {
+            "role": "system",
+            "content": (
+                "You are a recommendation system for selecting movies based on the user's preferences. "
+                "Your task is to recommend movies for the user based on their preferences. "
+                "Output 20 movies that match the user's preferences. Below are the user's answers to the preference questions in Russian, "
+                "however, all movie titles you recommend should strictly be in English. " + MOVIES_FORMAT_INSTRUCTION
+            )
+        },
+        {
+            "role": "user",
+            "content": str(text)
+        }
+    ]
+
+
+async def get_precomputed_candidates(preferences, seen_imdb_ids: set, session: AsyncSession, failed_titles: list[str] = ()) -> list[str] | None:
+    """Названия из заранее подготовленного пула для такой же комбинации ответов (см. precompute_candidates.py)"""
+    pool = await get_candidate_pool(answers_key(preferences), session)
+    if pool is None:
+        return None
+
+    titles = [
+        c['title'] for c in json.loads(pool.candidates)
+        if c['imdb_id'] not in seen_imdb_ids and c['title'] not in failed_titles
+    ]
+    min_unseen = 1 if usage_tracker.soft_exceeded('openai') else MIN_UNSEEN_TITLES
+    if len(titles) < min_unseen:
+        return None
+    logger.info(f"Рекомендации по анкете из готового пула {pool.answers_key}: {len(titles)} фильмов")
+    return titles
+
+
+async def get_movie_recommendation_by_preferences(user_id: int, session=AsyncSession, on_title=None, failed_titles: list[str] = ()):
+    preferences = await get_user_preferences(user_id, session)
+    seen_imdb_ids = await get_seen_imdb_ids(user_id, session)
 
-    content = response.choices[0].message.content
-    logger.info(f"Extracted CHAT GPT data: {content}")
+    if preferences:
+        titles = await get_precomputed_candidates(preferences, seen_imdb_ids, session, failed_titles)
+        if titles:
+            return titles
 
-    return extract_movies_from_gpt_response(content)
+    # Отправка запроса в OpenAI
+    return await request_movie_titles(
+        messages=build_preferences_messages(preferences),
+        on_title=on_title,
+        seen_imdb_ids=seen_imdb_ids,
+        exclusions=await build_exclusions(user_id, session, failed_titles),
+    )
 
 
 
 
-async def get_movie_recommendation_by_interaction(user_id: int, session: AsyncSession, state: FSMContext = None):
-    if state:
-        data = await state.get_data()
-        if data.get("preferences_priority"):
-            logger.info("Приоритет отдан анкете, получаем рекомендации по ней")
+async def get_movie_recommendation_by_interaction(user_id: int, session: AsyncSession, state: FSMContext = None, on_title=None, failed_titles: list[str] = (), fsm_data: dict | None = None):
+    """fsm_data - снимок состояния для фоновой подготовки порции: флаг приоритета анкеты читается, но не сбрасывается"""
+    if fsm_data is None and state:
+        fsm_data = await state.get_data()
+    if fsm_data and fsm_data.get("preferences_priority"):
+        logger.info("Приоритет отдан анкете, получаем рекомендации по ней")
+        if state:
             await state.update_data(preferences_priority=False)  # сбрасываем флаг, чтобы в следующий раз смотрели на лайки
-            return await get_movie_recommendation_by_preferences(user_id=user_id, session=session)
+        return await get_movie_recommendation_by_preferences(user_id=user_id, session=session, on_title=on_title, failed_titles=failed_titles)
         
     liked_movies = await get_movies_by_interaction(user_id, session, ['liked'])
 
@@ -120,7 +325,7 @@ async def get_movie_recommendation_by_interaction(user_id: int, session: AsyncSe
             text += f"- {movie.movie_name} ({movie.movie_genre}, {movie.movie_year}, {movie.movie_rating}/10)\n"
 
 
-        response = await client.chat.completions.create(
+        return await request_movie_titles(
             messages=[
                 {
                     "role": "system",
@@ -128,8 +333,7 @@ async def get_movie_recommendation_by_interaction(user_id: int, session: AsyncSe
                         "You are a movie recommendation system. Based on the list of movies that the user liked or recently watched, "
                         "recommend 20 new movies that match the user's preferences in genre, tone, and style.\n\n"
                         "Do not recommend movies that the user has already watched or liked — only suggest new and different ones.\n\n"
-                        "All recommended movie titles must be written strictly in English. "
-                        "Return the recommendations in the format of a Python list: Movies = [ ], containing only the movie titles as strings and nothing else."
+                        "All recommended movie titles must be written strictly in English. " + MOVIES_FORMAT_INSTRUCTION
                     )
                 },
                 {
@@ -137,38 +341,33 @@ async def get_movie_recommendation_by_interaction(user_id: int, session: AsyncSe
                     "content": str(text)
                 }
             ],
-            model='gpt-4o'
+            on_title=on_title,
+            seen_imdb_ids=await get_seen_imdb_ids(user_id, session),
+            exclusions=await build_exclusions(user_id, session, failed_titles),
         )
-        logger.info(f"Response from movie_rec: {response}")
-
-
-        content = response.choices[0].message.content
-        logger.info(f"Extracted CHAT GPT data: {content}")
-        return extract_movies_from_gpt_response(content)
 
 
     else:
         logger.info("_" * 100)
         logger.info("Недостаточно взаимодействий.\nВызываем рекомендации по анкете")
         logger.info("_" * 100)
-        return await get_movie_recommendation_by_preferences(user_id=user_id, session=session)
+        return await get_movie_recommendation_by_preferences(user_id=user_id, session=session, on_title=on_title, failed_titles=failed_titles)
 
 
 
 
-async def get_movie_recommendation_by_search(user_id: int, text: str, session: AsyncSession):
+async def get_movie_recommendation_by_search(user_id: int, text: str, session: AsyncSession, on_title=None):
     logger.info("_" * 100)
     logger.info(f"Запрос пользователя: {text}")
     
-    response = await client.chat.completions.create(
+    movies = await request_movie_titles(
         messages=[
             {
                 "role": "system",
                 "content": (
                     "You are a movie recommendation system. Based on user request, "
                     "recommend 5 movies/series (Depending on what the user requests).\n\n"
-                    "All recommended movie titles must be written strictly in English. "
-                    "Return the recommendations in the format of a Python list: Movies = [ ], containing only the movie titles as strings and nothing else."
+                    "All recommended movie titles must be written strictly in English. " + MOVIES_FORMAT_INSTRUCTION
                 )   
             },
             {
@@ -176,11 +375,10 @@ async def get_movie_recommendation_by_search(user_id: int, text: str, session: A
                 "content": str(f"Find movies that match user's request: {text}")
             }
         ],
-        model='gpt-4o'
+        # Без списка просмотренного: ответ уходит в общий кэш поиска, а чужое уже просмотренное
+        # отсеивается при чтении (search_stream, stream_movies)
+        on_title=on_title,
     )
-
-    content = response.choices[0].message.content
-    logger.info(f"Extracted CHAT GPT data: {content}")
     logger.info("_" * 100)
-    return extract_movies_from_gpt_response(content)
+    return movies
 
@@ -0,0 +1,49 @@
+from chat_gpt.questions import CALLBACK_IDS, QUESTION_KEYS
+
+
+# Ответ на вопрос хранится битовой маской: бит i = i-й вариант в CALLBACK_IDS[вопрос].
+# Порядок вариантов менять нельзя, новые добавлять только в конец - иначе старые маски поменяют смысл
+ANKETA_FIELDS = {
+    "question_1": "mood_mask",
+    "question_2": "genres_mask",
+    "question_3": "era_mask",
+    "question_4": "themes_mask",
+    "question_5": "country_mask",
+}
+
+_OPTION_TEXTS = {key: list(CALLBACK_IDS[key].values()) for key in QUESTION_KEYS}
+
+
+def encode_selected(question_key: str, selected: list[str]) -> int:
+    """Тексты выбранных вариантов (как их хранит FSM анкеты) -> маска"""
+    mask = 0
+    for bit, text in enumerate(_OPTION_TEXTS[question_key]):
+        if text in selected:
+            mask |= 1 << bit
+    return mask
+
+
+def decode_mask(question_key: str, mask: int) -> list[str]:
+    """Маска -> тексты вариантов в порядке CALLBACK_IDS"""
+    return [text for bit, text in enumerate(_OPTION_TEXTS[question_key]) if mask >> bit & 1]
+
+
+def anketa_masks(data: dict) -> dict:
+    """Данные FSM анкеты ({question_N}_selected) -> {поле Users_anketa: маска}"""
+    return {
+        field: encode_selected(question_key, data.get(f"{question_key}_selected", []))
+        for question_key, field in ANKETA_FIELDS.items()
+    }
+
+
+def answers_key(anketa) -> str:
+    """Ключ комбинации ответов: маски всех вопросов через дефис, например "5-1a0-1-0-3" """
+    return '-'.join(f"{getattr(anketa, field) or 0:x}" for field in ANKETA_FIELDS.values())
+
+
+def answers_text(anketa) -> dict:
+    """{question_key: "вариант, вариант"} для текста запроса к GPT"""
+    return {
+        question_key: ", ".join(decode_mask(question_key, getattr(anketa, field) or 0))
+        for question_key, field in ANKETA_FIELDS.items()
+    }
@@ -0,0 +1,122 @@
+import os
+import time
+import asyncio
+import logging
+
+from openai import APIError
+
+from utils.hedging import LatencyTracker
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModelStats:
+    """Задержка и расход токенов одной модели"""
+
+    def __init__(self):
+        self.latencies = LatencyTracker()
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, latency: float, usage):
+        self.latencies.record(latency)
+        if usage is not None:
+            self.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+            self.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+    def state(self) -> dict:
+        p50, p95 = self.latencies.percentile(0.5), self.latencies.percentile(0.95)
+        return {
+            'calls': self.calls,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'p50': round(p50, 2) if p50 is not None else None,
+            'p95': round(p95, 2) if p95 is not None else None,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+        }
+
+
+MODEL_STATS: dict[str, ModelStats] = {}
+
+
+def _stats(model: str) -> ModelStats:
+    return MODEL_STATS.setdefault(model, ModelStats())
+
+
+def models_state() -> dict:
+    return {model: stats.state() for model, stats in MODEL_STATS.items()}
+
+
+PRIMARY_SHARE = 0.6          # доля бюджета для основной модели, если её таймаут задан не меньше бюджета
+MIN_FALLBACK_TIMEOUT = 3.0   # секунд, меньше запасной модели не даём
+
+
+class ModelRoute:
+    """
+    Основная и быстрая запасная модель с общим бюджетом задержки.
+    Основной модели даётся primary_timeout секунд; не уложилась или упала - запрос отменяется
+    и уходит в fallback на оставшееся от budget время. budget=None - ждём основную модель без ограничения
+    """
+
+    def __init__(self, primary: str, fallback: str | None = None, budget: float | None = None, primary_timeout: float | None = None):
+        self.primary = primary
+        self.fallback = fallback
+        self.budget = budget
+        self.primary_timeout = primary_timeout or budget
+        if fallback and budget and self.primary_timeout >= budget:
+            # Иначе на запасную модель не останется времени и переключение никогда не сработает
+            self.primary_timeout = budget * PRIMARY_SHARE
+            logger.warning(f"Таймаут {primary} не меньше бюджета {budget} с, уменьшаем до {self.primary_timeout:.1f} с")
+
+    async def run(self, call):
+        """call(model) -> (ответ, usage); возвращает ответ первой модели, уложившейся в бюджет"""
+        started = time.monotonic()
+        try:
+            return await self._attempt(self.primary, call, self.primary_timeout)
+        except (asyncio.TimeoutError, APIError) as e:
+            if not self.fallback:
+                raise
+            logger.warning(f"{self.primary} не ответил за {self.primary_timeout} с или упал ({e!r}), переключаемся на {self.fallback}")
+
+        remaining = None
+        if self.budget:
+            # Бюджет мог уйти на основную модель целиком - запасной всё равно даём минимум времени
+            remaining = max(self.budget - (time.monotonic() - started), MIN_FALLBACK_TIMEOUT)
+        return await self._attempt(self.fallback, call, remaining)
+
+    @staticmethod
+    async def _attempt(model: str, call, timeout: float | None):
+        stats = _stats(model)
+        stats.calls += 1
+        started = time.monotonic()
+        try:
+            content, usage = await asyncio.wait_for(call(model), timeout)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            raise
+        except Exception:
+            stats.errors += 1
+            raise
+        stats.record(time.monotonic() - started, usage)
+        return content
+
+
+# Env: GPT_PRIMARY_MODEL, GPT_FALLBACK_MODEL, GPT_LATENCY_BUDGET (секунд на весь запрос), GPT_PRIMARY_TIMEOUT
+PRIMARY_MODEL = os.getenv('GPT_PRIMARY_MODEL', 'gpt-4o')
+FALLBACK_MODEL = os.getenv('GPT_FALLBACK_MODEL', 'gpt-4o-mini')
+
+# Запросы, которых ждёт пользователь в чате
+INTERACTIVE_ROUTE = ModelRoute(
+    PRIMARY_MODEL,
+    FALLBACK_MODEL,
+    budget=float(os.getenv('GPT_LATENCY_BUDGET', 20)),
+    primary_timeout=float(os.getenv('GPT_PRIMARY_TIMEOUT', 12)),
+)
+
+# Фоновые задачи (precompute_candidates.py): торопиться некуда, ждём основную модель
+BATCH_ROUTE = ModelRoute(PRIMARY_MODEL)
@@ -0,0 +1,275 @@
+import re
+import json
+import logging
+
+from utils.ttl_cache import TTLCache, MISSING
+
+
+logger = logging.getLogger(__name__)
+
+
+# Ответ GPT по схеме (structured outputs): {"movies": [{"title", "original_title", "year"}]}
+MOVIES_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "movie_recommendations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "movies": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "title": {"type": "string"},
+                            "original_title": {"type": "string"},
+                            "year": {"type": ["integer", "null"]},
+                        },
+                        "required": ["title", "original_title", "year"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["movies"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+MOVIES_FORMAT_INSTRUCTION = (
+    "Return JSON with a \"movies\" array. For every movie give \"title\" (the English title), "
+    "\"original_title\" (the title in the original language) and \"year\" (the release year)."
+)
+
+# Сколько ответов разобрано по схеме, старым форматом Movies = [...] и сколько не разобрано вовсе
+PARSE_STATS = {'json': 0, 'legacy': 0, 'failed': 0, 'invalid_items': 0}
+
+
+def parse_stats() -> dict:
+    total = PARSE_STATS['json'] + PARSE_STATS['legacy'] + PARSE_STATS['failed']
+    return {**PARSE_STATS, 'failure_rate': round(PARSE_STATS['failed'] / total, 3) if total else 0.0}
+
+
+def _validate_movie(item) -> dict | None:
+    if not isinstance(item, dict):
+        return None
+    title = item.get('title')
+    if not isinstance(title, str) or not title.strip():
+        return None
+
+    original_title = item.get('original_title')
+    if not isinstance(original_title, str) or not original_title.strip():
+        original_title = None
+
+    year = item.get('year')
+    if isinstance(year, str) and year.strip().isdigit():
+        year = int(year)
+    if not isinstance(year, int) or isinstance(year, bool) or not 1880 <= year <= 2100:
+        year = None
+
+    return {'title': title.strip(), 'original_title': original_title and original_title.strip(), 'year': year}
+
+
+def parse_movie_recommendations(content: str | None) -> list[dict]:
+    """
+    Проверяет ответ GPT по схеме и возвращает [{"title", "original_title", "year"}].
+    Если модель ответила не по схеме, пробуем старый формат Movies = [...]
+    """
+    try:
+        data = json.loads(content or '')
+    except ValueError:
+        data = None
+
+    if isinstance(data, dict) and isinstance(data.get('movies'), list):
+        movies = []
+        for item in data['movies']:
+            movie = _validate_movie(item)
+            if movie:
+                movies.append(movie)
+            else:
+                PARSE_STATS['invalid_items'] += 1
+        if movies:
+            PARSE_STATS['json'] += 1
+            return movies
+
+    titles = extract_movies_from_gpt_response(content or '')
+    if titles:
+        PARSE_STATS['legacy'] += 1
+        return [{'title': title, 'original_title': None, 'year': None} for title in titles]
+
+    PARSE_STATS['failed'] += 1
+    logger.warning(f"Не удалось разобрать ответ GPT, разборов с ошибкой: {PARSE_STATS['failed']}")
+    return []
+
+
+_TITLE_YEAR = re.compile(r'^(.*\S)\s*\((\d{4})\)$')
+
+
+def format_title(title: str, year: int | None) -> str:
+    """Название с годом "Dune (2021)": дальше по цепочке оно передаётся одной строкой, год нужен OMDb"""
+    return f"{title} ({year})" if year else title
+
+
+# Название на языке оригинала для строки из format_title: "Амели (2001)" -> "Le Fabuleux Destin d'Amélie Poulain".
+# Дальше по цепочке едет одна строка, а OMDb оригинальное название нужно как запасной запрос
+ORIGINAL_TITLE_TTL = 24 * 3600
+original_titles = TTLCache(maxsize=5000)
+
+
+def format_movie(movie: dict) -> str:
+    """format_title для разобранного фильма; заодно запоминает его оригинальное название"""
+    title = format_title(movie['title'], movie['year'])
+    if movie.get('original_title'):
+        original_titles.set(title, movie['original_title'], ORIGINAL_TITLE_TTL)
+    return title
+
+
+def original_title_for(title: str) -> str | None:
+    original = original_titles.get(title)
+    return None if original is MISSING else original
+
+
+def split_title_year(title: str) -> tuple[str, int | None]:
+    """Обратно к format_title: "Dune (2021)" -> ("Dune", 2021), "Dune" -> ("Dune", None)"""
+    match = _TITLE_YEAR.match(title.strip())
+    if not match:
+        return title.strip(), None
+    return match.group(1), int(match.group(2))
+
+
+def _decode_json_string(raw: str) -> str:
+    try:
+        return json.loads(f'"{raw}"')
+    except ValueError:
+        return raw
+
+
+class JsonTitleStream:
+    """
+    Инкрементальный разбор потока {"movies": [{"title": "...", "year": 2021, ...}, ...]}:
+    feed(кусок текста) возвращает названия фильмов, объекты которых закрылись в этом куске,
+    вместе с годом - "Dune (2021)" (см. format_title)
+    """
+
+    def __init__(self):
+        self.in_string = False
+        self.escaped = False
+        self.current = []
+        self.scalar = []           # число или null, которое читаем после ':'
+        self.key = None            # последний прочитанный ключ объекта
+        self.expect_value = False  # после ':' ждём значение
+        self.title = None
+        self.original_title = None
+        self.year = None
+
+    def _set_value(self, value):
+        if self.key == 'title' and isinstance(value, str) and value.strip():
+            self.title = value.strip()
+        elif self.key == 'original_title' and isinstance(value, str) and value.strip():
+            self.original_title = value.strip()
+        elif self.key == 'year':
+            self.year = int(value) if isinstance(value, str) and value.isdigit() else None
+
+    def feed(self, text: str) -> list[str]:
+        titles = []
+        for char in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    value = _decode_json_string(''.join(self.current))
+                    self.current = []
+                    if not self.expect_value:
+                        self.key = value
+                        continue
+                    self.expect_value = False
+                    self._set_value(value)
+                    continue
+                self.current.append(char)
+            elif char == '"':
+                self.in_string = True
+            elif char == ':':
+                self.expect_value = True
+            elif char in ',{}[]':
+                if self.scalar:
+                    self._set_value(''.join(self.scalar))
+                    self.scalar = []
+                self.expect_value = False
+                if char == '}' and self.title:
+                    titles.append(format_movie({'title': self.title, 'original_title': self.original_title, 'year': self.year}))
+                if char == '}':
+                    self.title, self.original_title, self.year = None, None, None
+            elif self.expect_value and not char.isspace():
+                self.scalar.append(char)
+        return titles
+
+
+class MovieTitleStream:
+    """
+    Инкрементальный разбор "Movies = ['A', "B", ...]": feed(кусок текста) возвращает названия,
+    строковые литералы которых закрылись в этом куске
+    """
+
+    START = re.compile(r"Movies\s*=\s*\[")
+
+    def __init__(self):
+        self.buffer = ''       # текст до начала списка
+        self.in_list = False
+        self.finished = False
+        self.quote = None      # открывающая кавычка текущего названия
+        self.escaped = False
+        self.current = []
+
+    def feed(self, text: str) -> list[str]:
+        if self.finished:
+            return []
+        if not self.in_list:
+            self.buffer += text
+            match = self.START.search(self.buffer)
+            if not match:
+                return []
+            self.in_list = True
+            text = self.buffer[match.end():]
+            self.buffer = ''
+
+        titles = []
+        for char in text:
+            if self.quote:
+                if self.escaped:
+                    self.current.append(char)
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == self.quote:
+                    title = ''.join(self.current).strip()
+                    if title:
+                        titles.append(title)
+                    self.quote, self.current = None, []
+                else:
+                    self.current.append(char)
+            elif char in ('"', "'"):
+                self.quote = char
+            elif char == ']':
+                self.finished = True
+                break
+        return titles
+
+
+def extract_movies_from_gpt_response(response_text: str) -> list[str]:
+    # Разбор по кавычкам не ломается на названиях с запятыми ("Crouching Tiger, Hidden Dragon")
+    titles = MovieTitleStream().feed(response_text)
+    if titles:
+        return titles
+
+    pattern = r"Movies\s*=\s*\[\s*(.*?)\s*\]"
+    match = re.search(pattern, response_text, re.DOTALL)
+    if not match:
+        logger.warning(f"Pattern not found in GPT response: {response_text}")
+        return []
+
+    movies_string = match.group(1)
+    return [movie.strip().strip('"').strip("'") for movie in re.split(r',\s*', movies_string)]
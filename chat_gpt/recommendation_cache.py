@@ -0,0 +1,109 @@
+import json
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+from database.engine import session_maker
+from database.orm_query import get_gpt_recommendation, save_gpt_recommendation
+from kinopoisk_imdb.imdb_cache import imdb_cache, normalize_title
+from utils.ttl_cache import TTLCache, MISSING
+
+
+logger = logging.getLogger(__name__)
+
+
+RECOMMENDATION_TTL = timedelta(days=3)
+MEMORY_SIZE = 1000
+MIN_UNSEEN_TITLES = 5    # если непросмотренных названий меньше - идём в GPT за новыми
+MAX_POOL_SIZE = 100      # сколько названий храним на один запрос
+
+
+def prompt_key(model: str, messages: list) -> str:
+    """Стабильный хэш входа запроса: одинаковые анкеты и одинаковые 5 последних лайков дают один ключ"""
+    payload = json.dumps({'model': model, 'messages': messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RecommendationCache:
+    """
+    Кэш ответов GPT: хэш запроса -> список названий. LRU в памяти + таблица gpt_recommendation.
+    Один и тот же список отдаётся разным пользователям, поэтому просмотренное отфильтровывается при чтении
+    """
+
+    def __init__(self, maxsize: int = MEMORY_SIZE):
+        self.memory = TTLCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    async def _load(self, key: str) -> list[str]:
+        titles = self.memory.get(key)
+        if titles is not MISSING:
+            return titles
+
+        try:
+            async with session_maker() as session:
+                row = await get_gpt_recommendation(key, session)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать кэш рекомендаций из базы: {e}")
+            return []
+        if row is None:
+            return []
+
+        titles = json.loads(row.titles)
+        self.memory.set(key, titles, ttl=0, expires_at=row.expires_at.timestamp())
+        return titles
+
+    async def get_unseen(self, key: str, seen_imdb_ids: set, failed_titles: list[str] = (),
+                         min_unseen: int = MIN_UNSEEN_TITLES) -> list[str] | None:
+        """
+        Непросмотренные названия из кэша или None, если их меньше min_unseen и нужен новый запрос к GPT.
+        failed_titles - названия, которые в этой серии запросов уже не удалось показать
+        """
+        titles = await self._load(key)
+        if titles:
+            await imdb_cache.load(titles)
+
+        unseen = []
+        for title in titles:
+            if title in failed_titles:
+                continue
+            record = imdb_cache.get(title)
+            if record is None:
+                continue  # OMDb такого фильма не знает
+            if record is not MISSING and record['imdb_id'] in seen_imdb_ids:
+                continue
+            unseen.append(title)
+
+        if len(unseen) < min_unseen:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return unseen
+
+    async def add(self, key: str, new_titles: list[str]):
+        """Дописывает новые названия к сохранённым: повторный одинаковый запрос пополняет общий пул"""
+        titles = await self._load(key)
+        known = {normalize_title(title) for title in titles}
+        merged = titles + [title for title in new_titles if normalize_title(title) not in known]
+        merged = merged[-MAX_POOL_SIZE:]
+
+        expires_at = datetime.now() + RECOMMENDATION_TTL
+        self.memory.set(key, merged, ttl=RECOMMENDATION_TTL.total_seconds())
+        try:
+            async with session_maker() as session:
+                await save_gpt_recommendation(key, json.dumps(merged, ensure_ascii=False), expires_at, session)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить рекомендации в кэш: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.memory),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'gpt_calls_avoided': self.hits,
+        }
+
+
+recommendation_cache = RecommendationCache()
@@ -0,0 +1,134 @@
+import re
+import json
+import logging
+import unicodedata
+from datetime import datetime, timedelta
+
+from database.engine import session_maker
+from database.orm_query import get_search_query, save_search_query
+from utils.ttl_cache import TTLCache, MISSING
+
+
+logger = logging.getLogger(__name__)
+
+
+SEARCH_TTL = timedelta(days=7)
+MEMORY_SIZE = 2000
+MAX_IMDB_IDS = 50   # сколько найденных фильмов храним на один запрос
+
+_TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+# Окончания русских слов уже в латинице: стемминг идёт после транслитерации, поэтому
+# "Гарри Поттер", "garri pottera" и "гарри поттера" дают один ключ
+_ENDINGS = sorted([
+    'ami', 'yami', 'ogo', 'ego', 'omu', 'emu', 'ymi', 'imi', 'oi', 'ei', 'ii', 'yi', 'aya', 'yaya', 'oe', 'ee',
+    'ye', 'ie', 'om', 'em', 'am', 'yam', 'ah', 'yah', 'ov', 'ev', 'a', 'ya', 'y', 'i', 'u', 'yu', 'e', 'o', 's',
+], key=len, reverse=True)
+_WORD = re.compile(r'\w+')
+
+
+def _strip_ending(word: str) -> str:
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def _stem(word: str) -> str:
+    # Срезаем, пока срезается: "kosmose" и "kosmos" оба сходятся к "kosm"
+    stemmed = _strip_ending(word)
+    while stemmed != word:
+        word, stemmed = stemmed, _strip_ending(stemmed)
+    return word
+
+
+def normalize_query(text: str) -> str:
+    """
+    Ключ кэша поиска: без регистра, лишних пробелов и пунктуации, в латинице и без окончаний.
+    "Фильмы как Интерстеллар!" и "фильм как interstellar" дают один ключ.
+    Названия ("Чужой") не стеммим: иначе "Чужой" и "Чужие" сошлись бы к одному "chuzh" и разным фильмам
+    """
+    title = is_title_query(text)
+    text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+    words = [''.join(_TRANSLIT.get(char, char) for char in word) for word in _WORD.findall(text)]
+    return ' '.join(word if title else _stem(word) for word in words)
+
+
+# Слова и начала слов, по которым видно, что пользователь описывает, что хочет, а не называет фильм
+_DESCRIPTIVE_WORDS = {
+    'про', 'как', 'типа', 'вроде', 'хочу', 'что', 'где', 'кто', 'чтобы', 'кино', 'о', 'об',
+    'about', 'like', 'similar', 'with', 'where', 'recommend', 'movie', 'movies', 'film', 'films', 'series',
+}
+_DESCRIPTIVE_PREFIXES = ('фильм', 'сериал', 'мульт', 'похож', 'посовет', 'порекоменд', 'котор', 'лучш', 'интересн')
+MAX_TITLE_WORDS = 6
+
+
+def is_title_query(text: str) -> bool:
+    """Похоже ли на название фильма ("Гарри Поттер"), а не на описание ("фильмы про космос")"""
+    words = _WORD.findall(text.casefold())
+    if not words or len(words) > MAX_TITLE_WORDS or '?' in text:
+        return False
+    return not any(word in _DESCRIPTIVE_WORDS or word.startswith(_DESCRIPTIVE_PREFIXES) for word in words)
+
+
+class SearchQueryCache:
+    """Общий для всех пользователей кэш поиска: нормализованный запрос -> найденные IMDb ID"""
+
+    def __init__(self, maxsize: int = MEMORY_SIZE):
+        self.memory = TTLCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, text: str) -> list[str]:
+        key = normalize_query(text)
+        imdb_ids = self.memory.get(key)
+        if imdb_ids is MISSING:
+            imdb_ids = []
+            try:
+                async with session_maker() as session:
+                    row = await get_search_query(key, session)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать кэш поиска из базы: {e}")
+                row = None
+            if row is not None:
+                imdb_ids = json.loads(row.imdb_ids)
+                self.memory.set(key, imdb_ids, ttl=0, expires_at=row.expires_at.timestamp())
+        return imdb_ids
+
+    def record(self, hit: bool):
+        # Попаданием считаем только запрос, который удалось обслужить без GPT с учётом фильтра пользователя
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    async def add(self, text: str, new_imdb_ids: list[str]):
+        key = normalize_query(text)
+        imdb_ids = await self.get(text)
+        merged = list(dict.fromkeys(imdb_ids + new_imdb_ids))[:MAX_IMDB_IDS]
+        if not merged:
+            return
+
+        self.memory.set(key, merged, ttl=SEARCH_TTL.total_seconds())
+        try:
+            async with session_maker() as session:
+                await save_search_query(key, json.dumps(merged), datetime.now() + SEARCH_TTL, session)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить запрос '{key}' в кэш поиска: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.memory),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'gpt_calls_avoided': self.hits,
+        }
+
+
+search_cache = SearchQueryCache()
@@ -1,6 +1,8 @@
 import os
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from database.models import Base
+from database.fulltext import create_fulltext_index, drop_fulltext_index
+from database.schema_upgrade import upgrade_schema
 
 engine = create_async_engine(os.getenv("DB_URL"), echo=False)
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
@@ -8,8 +10,11 @@ session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_c
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await upgrade_schema(conn)
+        await create_fulltext_index(conn)
 
 
 async def drop_db():
     async with engine.begin() as conn:
+        await drop_fulltext_index(conn)
         await conn.run_sync(Base.metadata.drop_all)
\ No newline at end of file
@@ -0,0 +1,116 @@
+import re
+import logging
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncConnection
+
+from database.models import Movies
+
+
+logger = logging.getLogger(__name__)
+
+
+# SQLite (разработка): FTS5-таблица поверх movies, синхронизируется триггерами
+_SQLITE_FTS_TABLE = """
+CREATE VIRTUAL TABLE movies_fts USING fts5(
+    movie_name, movie_description, movie_genre,
+    content='movies', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+)
+"""
+_SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies BEGIN
+        INSERT INTO movies_fts(rowid, movie_name, movie_description, movie_genre)
+        VALUES (new.rowid, new.movie_name, new.movie_description, new.movie_genre);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies BEGIN
+        INSERT INTO movies_fts(movies_fts, rowid, movie_name, movie_description, movie_genre)
+        VALUES ('delete', old.rowid, old.movie_name, old.movie_description, old.movie_genre);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS movies_fts_update AFTER UPDATE ON movies BEGIN
+        INSERT INTO movies_fts(movies_fts, rowid, movie_name, movie_description, movie_genre)
+        VALUES ('delete', old.rowid, old.movie_name, old.movie_description, old.movie_genre);
+        INSERT INTO movies_fts(rowid, movie_name, movie_description, movie_genre)
+        VALUES (new.rowid, new.movie_name, new.movie_description, new.movie_genre);
+    END
+    """,
+]
+# Вес колонок в bm25: название важнее жанра, жанр важнее описания
+_SQLITE_SEARCH = """
+SELECT movies.* FROM movies_fts JOIN movies ON movies.rowid = movies_fts.rowid
+WHERE movies_fts MATCH :match
+ORDER BY bm25(movies_fts, 10.0, 1.0, 2.0)
+LIMIT :limit
+"""
+
+# Postgres: GIN-индекс по выражению; название - вес A, жанр - B, описание - C
+_PG_TSVECTOR = (
+    "setweight(to_tsvector('russian', coalesce(movie_name, '')), 'A') || "
+    "setweight(to_tsvector('russian', coalesce(movie_genre, '')), 'B') || "
+    "setweight(to_tsvector('russian', coalesce(movie_description, '')), 'C')"
+)
+
+_WORD = re.compile(r'\w+')
+
+
+async def create_fulltext_index(conn: AsyncConnection):
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        exists = await conn.scalar(text("SELECT 1 FROM sqlite_master WHERE name = 'movies_fts'"))
+        if not exists:
+            await conn.execute(text(_SQLITE_FTS_TABLE))
+            # Фильмы, сохранённые до появления индекса
+            await conn.execute(text("INSERT INTO movies_fts(movies_fts) VALUES ('rebuild')"))
+        for trigger in _SQLITE_TRIGGERS:
+            await conn.execute(text(trigger))
+    elif dialect == 'postgresql':
+        await conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_movies_fulltext ON movies USING GIN (({_PG_TSVECTOR}))"))
+    else:
+        logger.warning(f"Полнотекстовый поиск для {dialect} не поддерживается")
+
+
+async def drop_fulltext_index(conn: AsyncConnection):
+    # Индекс Postgres удаляется вместе с таблицей movies, FTS5-таблицу SQLite удаляем сами
+    if conn.dialect.name == 'sqlite':
+        await conn.execute(text("DROP TABLE IF EXISTS movies_fts"))
+
+
+def query_terms(query: str) -> list[str]:
+    """Слова запроса, обрезанные под поиск по префиксу: "Поттера" найдёт "Поттер" """
+    terms = []
+    for word in _WORD.findall(query.casefold()):
+        terms.append(word[:max(3, len(word) - 2)] if len(word) >= 5 else word)
+    return terms
+
+
+async def search_movies_fulltext(query: str, session: AsyncSession, limit: int = 10, title_only: bool = True) -> list:
+    """Фильмы из локального каталога, где встречаются все слова запроса (title_only - только в названии)"""
+    terms = query_terms(query)
+    if not terms:
+        return []
+
+    dialect = session.bind.dialect.name
+    if dialect == 'sqlite':
+        match = ' AND '.join(f'"{term}"*' for term in terms)
+        if title_only:
+            match = f"movie_name : ({match})"
+        stmt = select(Movies).from_statement(text(_SQLITE_SEARCH)).params(match=match, limit=limit)
+    elif dialect == 'postgresql':
+        weight = 'A' if title_only else ''
+        tsquery = ' & '.join(f"{term}:*{weight}" for term in terms)
+        stmt = (
+            select(Movies)
+            .where(text(f"({_PG_TSVECTOR}) @@ to_tsquery('russian', :tsquery)"))
+            .order_by(text(f"ts_rank({_PG_TSVECTOR}, to_tsquery('russian', :tsquery)) DESC"))
+            .limit(limit)
+            .params(tsquery=tsquery)
+        )
+    else:
+        return []
+
+    result = await session.scalars(stmt)
+    return result.all()
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import Mapped, DeclarativeBase, mapped_column, relationship
-from sqlalchemy import BigInteger, TIMESTAMP, Text, String, Float, Integer, ForeignKey, Boolean, DateTime, Index
+from sqlalchemy import BigInteger, TIMESTAMP, Text, String, Float, Integer, ForeignKey, Boolean, DateTime, Date, Index
 from sqlalchemy.ext.asyncio import AsyncAttrs
 
 
@@ -31,6 +31,9 @@ class Movies(Base):
     movie_duration: Mapped[str] = mapped_column(String, nullable=False)
     movie_type: Mapped[str] = mapped_column(String, nullable=True)
     movie_omdb_poster: Mapped[str] = mapped_column(String, nullable=False)
+    movie_valid_poster: Mapped[str] = mapped_column(String, nullable=True)            # рабочий постер (Кинопоиск или OMDb), '' - рабочего нет
+    movie_poster_checked_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=True)  # когда проверяли постеры, None - ещё не проверяли
+    movie_poster_file_id: Mapped[str] = mapped_column(String, nullable=True)          # file_id постера, уже загруженного в Telegram
 
 
 
@@ -44,11 +47,12 @@ class Users_anketa(Base):
 
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.user_id"), primary_key=True, index=True)
     user_rec_status: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
-    mood: Mapped[str] = mapped_column(String, nullable=False)
-    genres: Mapped[str] = mapped_column(String, nullable=False)
-    era: Mapped[str] = mapped_column(String, nullable=False)
-    country: Mapped[str] = mapped_column(String, nullable=False)
-    themes: Mapped[str] = mapped_column(String, nullable=False)
+    # Битовые маски выбранных вариантов, см. chat_gpt/anketa_mask.py
+    mood_mask: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    genres_mask: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    era_mask: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    themes_mask: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    country_mask: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
 
     user: Mapped[Users] = relationship(backref="anketa")
 
@@ -68,3 +72,89 @@ class Users_interaction(Base):
     __table_args__ = (
         Index("ix_user_interaction", "user_id", "interaction_type"),
     )
+
+# ─────────────────────────────────────
+
+class Imdb_resolution(Base):
+    __tablename__ = "imdb_resolution"
+
+    title_key: Mapped[str] = mapped_column(String, primary_key=True)  # нормализованное название
+    imdb_id: Mapped[str] = mapped_column(String, nullable=True)       # None - фильм не найден в OMDb
+    omdb_data: Mapped[str] = mapped_column(Text, nullable=True)       # JSON с постером, годом, жанрами, рейтингом
+    confidence: Mapped[float] = mapped_column(Float, nullable=True)   # сходство найденного фильма с запрошенным названием и годом
+    created_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False)
+    expires_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False, index=True)
+
+# ─────────────────────────────────────
+
+class Kinopoisk_unservable(Base):
+    __tablename__ = "kinopoisk_unservable"
+
+    imdb: Mapped[str] = mapped_column(String, primary_key=True)
+    reason: Mapped[str] = mapped_column(String, nullable=False)        # "not_found" или "incomplete"
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+    movie_omdb_poster: Mapped[str] = mapped_column(String, nullable=True)
+    retry_after: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False, index=True)
+
+# ─────────────────────────────────────
+
+class Gpt_recommendation(Base):
+    __tablename__ = "gpt_recommendation"
+
+    prompt_hash: Mapped[str] = mapped_column(String(64), primary_key=True)  # sha256 от модели и сообщений запроса
+    titles: Mapped[str] = mapped_column(Text, nullable=False)               # JSON-список названий от GPT
+    created_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False)
+    expires_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False, index=True)
+
+# ─────────────────────────────────────
+
+class Anketa_candidates(Base):
+    __tablename__ = "anketa_candidates"
+
+    answers_key: Mapped[str] = mapped_column(String, primary_key=True)  # маски ответов анкеты, см. answers_key()
+    candidates: Mapped[str] = mapped_column(Text, nullable=False)       # JSON [{"title": ..., "imdb_id": ...}]
+    users_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    created_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False)
+
+# ─────────────────────────────────────
+
+class Search_query(Base):
+    __tablename__ = "search_query"
+
+    query_key: Mapped[str] = mapped_column(String, primary_key=True)  # нормализованный текст запроса
+    imdb_ids: Mapped[str] = mapped_column(Text, nullable=False)       # JSON-список найденных IMDb ID по порядку
+    created_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False)
+    expires_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False, index=True)
+
+# ─────────────────────────────────────
+
+class Api_usage(Base):
+    __tablename__ = "api_usage"
+
+    # Суточная сводка обращений к внешним сервисам: провайдер x обработчик x пользователь
+    day: Mapped[Date] = mapped_column(Date, primary_key=True)
+    provider: Mapped[str] = mapped_column(String, primary_key=True)   # omdb, kinopoisk, openai
+    handler: Mapped[str] = mapped_column(String, primary_key=True)    # имя обработчика aiogram или 'background'
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)  # 0 - фоновые задачи
+    calls: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    errors: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    tokens: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    bytes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+# ─────────────────────────────────────
+
+class Candidate_queue(Base):
+    __tablename__ = "candidate_queue"
+
+    # Очередь ещё не показанных пользователю фильмов: остаток карусели после "Стоп" и подготовленные порции
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.user_id"), nullable=False)
+    movie_id: Mapped[str] = mapped_column(String, ForeignKey("movies.imdb"), nullable=False)
+    position: Mapped[int] = mapped_column(BigInteger, nullable=False)  # порядок выдачи: меньше - раньше
+    created_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False)
+    expires_at: Mapped[DateTime] = mapped_column(TIMESTAMP, nullable=False, index=True)
+
+    __table_args__ = (
+        Index("ix_candidate_queue_position", "user_id", "position"),
+        Index("ix_candidate_queue_movie", "user_id", "movie_id", unique=True),
+    )
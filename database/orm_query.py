@@ -1,47 +1,32 @@
-from database.models import Users_anketa, Users, Movies, Users_interaction
+from database.models import Users_anketa, Users, Movies, Users_interaction, Imdb_resolution, Kinopoisk_unservable, Gpt_recommendation, Anketa_candidates, Search_query, Api_usage, Candidate_queue
 from sqlalchemy.ext.asyncio import AsyncSession
-from datetime import datetime
-from sqlalchemy import select, delete
-import aiohttp
+import json
+from datetime import datetime, timedelta, date
+
+from chat_gpt.anketa_mask import ANKETA_FIELDS, anketa_masks
+from sqlalchemy import select, delete, func, or_, case
 from sqlalchemy import update
-import os
-API_KEY_OMDB = os.getenv('OMDB_API_KEY')
-timeout = aiohttp.ClientTimeout(total=5)
 
 
 
 #функция для добавления ответов пользователя в базу
 async def orm_add_user_rec_set(user_id: int, session: AsyncSession, data: dict):
     try:
-        def get_answer(key: str) -> str:
-            return ", ".join(data.get(f"{key}_selected", []))
-
-        # Подготавливаем данные
-        mood = get_answer("question_1")
-        genres = get_answer("question_2")
-        era = get_answer("question_3")
-        themes = get_answer("question_4")
-        country = get_answer("question_5")
+        # Ответы храним битовыми масками, а не строками с перечислением вариантов
+        masks = anketa_masks(data)
 
         query = select(Users_anketa).where(Users_anketa.user_id == user_id)
         existing = await session.scalar(query)
 
         if existing:
             existing.user_rec_status = True
-            existing.mood = mood
-            existing.genres = genres
-            existing.era = era
-            existing.country = country
-            existing.themes = themes
+            for field, mask in masks.items():
+                setattr(existing, field, mask)
         else:
             new_obj = Users_anketa(
                 user_id=user_id,
                 user_rec_status=True,
-                mood=mood,
-                genres=genres,
-                era=era,
-                country=country,
-                themes=themes,
+                **masks,
             )
             session.add(new_obj)
 
@@ -193,7 +178,8 @@ async def add_movie(
     movie_duration: str,  # строка, а не int
     movie_type: str,      # 👈 добавлено
     session: AsyncSession,
-    movie_omdb_poster: str = ""
+    movie_omdb_poster: str = "",
+    movie_valid_poster: str | None = None
 ):
     obj = Movies(
         imdb=movie_id,
@@ -205,28 +191,14 @@ async def add_movie(
         movie_genre=movie_genre,
         movie_duration=movie_duration,
         movie_type=movie_type,
-        movie_omdb_poster=movie_omdb_poster or ""     # 👈 передаём в БД
+        movie_omdb_poster=movie_omdb_poster or "",    # 👈 передаём в БД
+        movie_valid_poster=movie_valid_poster,
+        movie_poster_checked_at=datetime.now() if movie_valid_poster is not None else None,
+        movie_poster_file_id=None     # постер мог смениться - загрузим в Telegram заново
     )
-    session.add(obj)
+    await session.merge(obj)  # карточку, собранную по OMDb, перезаписываем данными Кинопоиска
     await session.commit()
 
-# database/orm_query.py
-async def add_omdb_poster_to_db(imdb_id: str, session: AsyncSession) -> str:
-    url = f"http://www.omdbapi.com/?i={imdb_id}&apikey={API_KEY_OMDB}"
-    async with aiohttp.ClientSession() as http:
-        async with http.get(url) as response:
-            data = await response.json()
-            poster = data.get("Poster", "")
-            if poster and poster != "N/A":
-                await session.execute(
-                    update(Movies).where(Movies.imdb == imdb_id).values(movie_omdb_poster=poster)
-                )
-                await session.commit()
-                return poster
-    return ""
-
-
-
 #функция для проверки существования фильма в базе
 async def get_movie_from_db(imdb: str, session: AsyncSession):
     query = select(Movies).where(Movies.imdb == imdb)
@@ -243,6 +215,44 @@ async def get_movies_from_db_by_imdb_list(imdb_ids: list[str], session: AsyncSes
     return {movie.imdb: movie for movie in result}
 
 
+#функция для сохранения результатов проверки постеров {imdb: рабочий постер или ''}
+async def update_movie_posters(posters: dict, session: AsyncSession):
+    try:
+        checked_at = datetime.now()
+        for imdb, valid_poster in posters.items():
+            await session.execute(
+                update(Movies)
+                .where(Movies.imdb == imdb)
+                .values(
+                    movie_valid_poster=valid_poster,
+                    movie_poster_checked_at=checked_at,
+                    # file_id относится к старому постеру, если постер сменился
+                    movie_poster_file_id=case(
+                        (Movies.movie_valid_poster == valid_poster, Movies.movie_poster_file_id),
+                        else_=None,
+                    ),
+                )
+            )
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+#функция для сохранения file_id постера после загрузки в Telegram (None - сбросить)
+async def save_movie_poster_file_id(imdb: str, file_id: str | None, session: AsyncSession):
+    try:
+        await session.execute(
+            update(Movies)
+            .where(Movies.imdb == imdb)
+            .values(movie_poster_file_id=file_id)
+        )
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
 async def reset_anketa_in_db(user_id: int, session: AsyncSession):
     try:
         # Ищем анкету пользователя в базе
@@ -254,11 +264,8 @@ async def reset_anketa_in_db(user_id: int, session: AsyncSession):
         
         # Сбрасываем все поля анкеты на начальные значения
         anketa.user_rec_status = False  # Статус рекомендаций
-        anketa.mood = ""
-        anketa.genres = ""
-        anketa.era = ""
-        anketa.country = ""
-        anketa.themes = ""
+        for field in ANKETA_FIELDS.values():
+            setattr(anketa, field, 0)
     
         
         # Сохраняем изменения в базе данных
@@ -270,4 +277,351 @@ async def reset_anketa_in_db(user_id: int, session: AsyncSession):
         return f"Ошибка при сбросе анкеты: {e}"
 
 
-                                
\ No newline at end of file
+
+#функция для получения сохранённых результатов поиска IMDb ID по нормализованным названиям
+async def get_imdb_resolutions(title_keys: list[str], session: AsyncSession) -> dict:
+    """Возвращает словарь {title_key: Imdb_resolution} только для неистёкших записей"""
+    if not title_keys:
+        return {}
+
+    stmt = select(Imdb_resolution).where(
+        Imdb_resolution.title_key.in_(title_keys),
+        Imdb_resolution.expires_at > datetime.now()
+    )
+    result = await session.scalars(stmt)
+    return {row.title_key: row for row in result}
+
+
+#функция для сохранения результата поиска IMDb ID (в том числе отрицательного)
+async def save_imdb_resolution(title_key: str, imdb_id: str | None, omdb_data: str | None, expires_at: datetime, session: AsyncSession,
+                               confidence: float | None = None):
+    try:
+        await session.merge(Imdb_resolution(
+            title_key=title_key,
+            imdb_id=imdb_id,
+            omdb_data=omdb_data,
+            confidence=confidence,
+            created_at=datetime.now(),
+            expires_at=expires_at
+        ))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+
+#функция для получения последних просмотренных пользователем фильмов (сначала самые свежие)
+async def get_recent_seen_movies(user_id: int, session: AsyncSession, interaction_types: list, limit: int = 100) -> list:
+    stmt = (
+        select(Movies.imdb, Movies.movie_name, Movies.movie_year)
+        .join(Users_interaction, Users_interaction.movie_id == Movies.imdb)
+        .where(Users_interaction.user_id == user_id, Users_interaction.interaction_type.in_(interaction_types))
+        .order_by(Users_interaction.id.desc())
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return result.all()
+
+
+#функция для получения английских названий из OMDb по IMDb ID
+async def get_omdb_titles(imdb_ids: list[str], session: AsyncSession) -> dict:
+    if not imdb_ids:
+        return {}
+
+    stmt = select(Imdb_resolution.imdb_id, Imdb_resolution.omdb_data).where(
+        Imdb_resolution.imdb_id.in_(imdb_ids),
+        Imdb_resolution.omdb_data.is_not(None)
+    )
+    result = await session.execute(stmt)
+    return {imdb_id: json.loads(omdb_data).get('title') for imdb_id, omdb_data in result}
+
+
+#функция для получения сохранённого ответа GPT по хэшу запроса
+async def get_gpt_recommendation(prompt_hash: str, session: AsyncSession):
+    stmt = select(Gpt_recommendation).where(
+        Gpt_recommendation.prompt_hash == prompt_hash,
+        Gpt_recommendation.expires_at > datetime.now()
+    )
+    return await session.scalar(stmt)
+
+
+#функция для сохранения ответа GPT (список названий в JSON)
+async def save_gpt_recommendation(prompt_hash: str, titles: str, expires_at: datetime, session: AsyncSession):
+    try:
+        await session.merge(Gpt_recommendation(
+            prompt_hash=prompt_hash,
+            titles=titles,
+            created_at=datetime.now(),
+            expires_at=expires_at
+        ))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+#функция для получения сохранённого результата поиска по нормализованному запросу
+async def get_search_query(query_key: str, session: AsyncSession):
+    stmt = select(Search_query).where(
+        Search_query.query_key == query_key,
+        Search_query.expires_at > datetime.now()
+    )
+    return await session.scalar(stmt)
+
+
+async def save_search_query(query_key: str, imdb_ids: str, expires_at: datetime, session: AsyncSession):
+    try:
+        await session.merge(Search_query(
+            query_key=query_key,
+            imdb_ids=imdb_ids,
+            created_at=datetime.now(),
+            expires_at=expires_at
+        ))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+#функция для получения самых частых комбинаций ответов анкеты
+async def get_top_anketa_combinations(session: AsyncSession, limit: int = 50) -> list:
+    fields = [getattr(Users_anketa, field) for field in ANKETA_FIELDS.values()]
+    stmt = (
+        select(*fields, func.count().label('users_count'))
+        .where(Users_anketa.user_rec_status == True)
+        .group_by(*fields)
+        .order_by(func.count().desc())
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return result.all()
+
+
+#функция для получения заранее подготовленных кандидатов для комбинации ответов
+async def get_candidate_pool(answers_key: str, session: AsyncSession):
+    return await session.get(Anketa_candidates, answers_key)
+
+
+async def save_candidate_pool(answers_key: str, candidates: str, users_count: int, session: AsyncSession):
+    try:
+        await session.merge(Anketa_candidates(
+            answers_key=answers_key,
+            candidates=candidates,
+            users_count=users_count,
+            created_at=datetime.now()
+        ))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+UNSERVABLE_RETRY_BASE = timedelta(days=1)
+UNSERVABLE_RETRY_MAX = timedelta(days=30)
+# Карточка по OMDb - следствие сбоя Кинопоиска, а не отсутствия фильма: перепроверяем через минуты, а не дни
+OMDB_ONLY_REASON = 'omdb_only'
+OMDB_ONLY_RETRY = timedelta(minutes=10)
+
+
+#функция для получения IMDb ID, которые Кинопоиск не отдаёт и перепроверять их ещё рано
+async def get_unservable_imdb_ids(imdb_ids: list[str], session: AsyncSession) -> set:
+    if not imdb_ids:
+        return set()
+
+    stmt = select(Kinopoisk_unservable.imdb).where(
+        Kinopoisk_unservable.imdb.in_(imdb_ids),
+        Kinopoisk_unservable.retry_after > datetime.now()
+    )
+    result = await session.scalars(stmt)
+    return set(result)
+
+
+#функция для записи IMDb ID, по которому Кинопоиск не вернул годных данных
+async def mark_unservable(imdb_id: str, reason: str, session: AsyncSession, movie_omdb_poster: str = ""):
+    """Каждая следующая неудача удваивает паузу до повторной попытки (от 1 до 30 дней); omdb_only - через OMDB_ONLY_RETRY"""
+    try:
+        existing = await session.get(Kinopoisk_unservable, imdb_id)
+        attempts = existing.attempts + 1 if existing else 1
+        if reason == OMDB_ONLY_REASON:
+            delay = OMDB_ONLY_RETRY
+        else:
+            delay = min(UNSERVABLE_RETRY_BASE * 2 ** (attempts - 1), UNSERVABLE_RETRY_MAX)
+
+        if existing:
+            existing.reason = reason
+            existing.attempts = attempts
+            existing.retry_after = datetime.now() + delay
+            existing.movie_omdb_poster = movie_omdb_poster or existing.movie_omdb_poster
+        else:
+            session.add(Kinopoisk_unservable(
+                imdb=imdb_id,
+                reason=reason,
+                attempts=attempts,
+                movie_omdb_poster=movie_omdb_poster,
+                retry_after=datetime.now() + delay
+            ))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+#функция для получения фильмов, сохранённых только по данным OMDb, которые пора заново запросить у Кинопоиска
+async def get_expired_omdb_only_ids(imdb_ids: list[str], session: AsyncSession) -> set:
+    if not imdb_ids:
+        return set()
+
+    stmt = select(Kinopoisk_unservable.imdb).where(
+        Kinopoisk_unservable.imdb.in_(imdb_ids),
+        Kinopoisk_unservable.reason == OMDB_ONLY_REASON,
+        Kinopoisk_unservable.retry_after <= datetime.now()
+    )
+    result = await session.scalars(stmt)
+    return set(result)
+
+
+#функция для получения записей, которые пора перепроверить
+async def get_expired_unservable(session: AsyncSession, limit: int = 200) -> list:
+    stmt = select(Kinopoisk_unservable).where(
+        Kinopoisk_unservable.retry_after <= datetime.now()
+    ).order_by(Kinopoisk_unservable.retry_after).limit(limit)
+    result = await session.scalars(stmt)
+    return result.all()
+
+
+async def delete_unservable(imdb_id: str, session: AsyncSession):
+    try:
+        await session.execute(delete(Kinopoisk_unservable).where(Kinopoisk_unservable.imdb == imdb_id))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+#функция для получения фильмов из локального каталога, которые пользователь ещё не видел
+async def get_unseen_movies_from_catalog(user_id: int, session: AsyncSession, limit: int = 20):
+    """Запасной источник рекомендаций, когда внешние сервисы недоступны: лучшие по рейтингу фильмы из базы"""
+    seen = select(Users_interaction.movie_id).where(Users_interaction.user_id == user_id)
+    query = select(Movies).where(Movies.imdb.not_in(seen)).order_by(Movies.movie_rating.desc()).limit(limit)
+    result = await session.scalars(query)
+    return result.all()
+
+
+#функция для добавления счётчиков обращений к внешним сервисам в суточную сводку
+async def add_api_usage(rows: list[dict], session: AsyncSession):
+    try:
+        for row in rows:
+            key = (row['day'], row['provider'], row['handler'], row['user_id'])
+            existing = await session.get(Api_usage, key)
+            if existing:
+                for counter in ('calls', 'errors', 'tokens', 'bytes'):
+                    setattr(existing, counter, getattr(existing, counter) + row[counter])
+            else:
+                session.add(Api_usage(**row))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+#функция для получения суммарного расхода по провайдерам за день
+async def get_api_usage_totals(day: date, session: AsyncSession) -> dict:
+    stmt = (
+        select(
+            Api_usage.provider,
+            func.sum(Api_usage.calls).label('calls'),
+            func.sum(Api_usage.errors).label('errors'),
+            func.sum(Api_usage.tokens).label('tokens'),
+            func.sum(Api_usage.bytes).label('bytes'),
+        )
+        .where(Api_usage.day == day)
+        .group_by(Api_usage.provider)
+    )
+    result = await session.execute(stmt)
+    return {
+        row.provider: {'calls': row.calls, 'errors': row.errors, 'tokens': row.tokens, 'bytes': row.bytes}
+        for row in result
+    }
+
+
+# Что пользователь уже видел: такие фильмы в очередь кандидатов не попадают
+QUEUE_SEEN_INTERACTIONS = ['liked', 'disliked', 'skipped', 'watched']
+CANDIDATE_QUEUE_TTL = timedelta(days=14)
+
+
+#функция для добавления фильмов в очередь кандидатов пользователя одним коммитом (front=True - в начало очереди)
+async def enqueue_candidates(user_id: int, imdb_ids: list[str], session: AsyncSession, front: bool = False) -> int:
+    imdb_ids = list(dict.fromkeys(imdb_ids))
+    if not imdb_ids:
+        return 0
+    try:
+        known = set(await session.scalars(select(Movies.imdb).where(Movies.imdb.in_(imdb_ids))))
+        seen = set(await session.scalars(select(Users_interaction.movie_id).where(
+            Users_interaction.user_id == user_id,
+            Users_interaction.movie_id.in_(imdb_ids),
+            Users_interaction.interaction_type.in_(QUEUE_SEEN_INTERACTIONS)
+        )))
+        queued = set(await session.scalars(select(Candidate_queue.movie_id).where(
+            Candidate_queue.user_id == user_id,
+            Candidate_queue.movie_id.in_(imdb_ids)
+        )))
+        new_ids = [imdb_id for imdb_id in imdb_ids if imdb_id in known and imdb_id not in seen | queued]
+        if not new_ids:
+            return 0
+
+        # Крайняя позиция берётся по индексу (user_id, position), без просмотра всей очереди
+        edge = await session.scalar(
+            select((func.min if front else func.max)(Candidate_queue.position)).where(Candidate_queue.user_id == user_id)
+        )
+        if edge is None:
+            start = 0
+        else:
+            start = edge - len(new_ids) if front else edge + 1
+
+        now = datetime.now()
+        session.add_all([
+            Candidate_queue(
+                user_id=user_id,
+                movie_id=imdb_id,
+                position=start + offset,
+                created_at=now,
+                expires_at=now + CANDIDATE_QUEUE_TTL
+            )
+            for offset, imdb_id in enumerate(new_ids)
+        ])
+        await session.commit()
+        return len(new_ids)
+    except Exception:
+        await session.rollback()
+        raise
+
+
+#функция для получения первых фильмов из очереди кандидатов (взятые удаляются из очереди)
+async def pop_candidates(user_id: int, session: AsyncSession, limit: int = 20) -> list:
+    try:
+        # Заодно выбрасываем истёкшие записи и фильмы, которые пользователь уже оценил
+        seen = select(Users_interaction.movie_id).where(
+            Users_interaction.user_id == user_id,
+            Users_interaction.interaction_type.in_(QUEUE_SEEN_INTERACTIONS)
+        )
+        await session.execute(delete(Candidate_queue).where(
+            Candidate_queue.user_id == user_id,
+            or_(Candidate_queue.expires_at <= datetime.now(), Candidate_queue.movie_id.in_(seen))
+        ))
+
+        stmt = (
+            select(Candidate_queue.id, Movies)
+            .join(Movies, Movies.imdb == Candidate_queue.movie_id)
+            .where(Candidate_queue.user_id == user_id)
+            .order_by(Candidate_queue.position)
+            .limit(limit)
+        )
+        rows = (await session.execute(stmt)).all()
+        if rows:
+            await session.execute(delete(Candidate_queue).where(Candidate_queue.id.in_([row.id for row in rows])))
+        await session.commit()
+        return [row.Movies for row in rows]
+    except Exception:
+        await session.rollback()
+        raise
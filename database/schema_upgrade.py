@@ -0,0 +1,93 @@
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from database.models import Base
+from chat_gpt.anketa_mask import ANKETA_FIELDS, encode_selected
+from chat_gpt.questions import CALLBACK_IDS
+
+
+logger = logging.getLogger(__name__)
+
+
+def _column_ddl(column, dialect) -> str:
+    ddl = f"{column.name} {column.type.compile(dialect=dialect)}"
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is not None:
+        ddl += f" DEFAULT {int(default) if isinstance(default, bool) else repr(default)}"
+    if not column.nullable and default is not None:
+        ddl += " NOT NULL"
+    return ddl
+
+
+def _add_missing_columns(sync_conn) -> list[str]:
+    """
+    Колонки, которые появились в моделях после создания таблиц: create_all их не добавляет.
+    NOT NULL без значения по умолчанию добавить к заполненной таблице нельзя - такие колонки остаются nullable
+    """
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue  # новую таблицу целиком создаст create_all
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {_column_ddl(column, sync_conn.dialect)}"))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+# Анкета раньше хранила ответы строками "вариант, вариант" в этих колонках (см. chat_gpt/anketa_mask.py)
+LEGACY_ANKETA_COLUMNS = {
+    "question_1": "mood",
+    "question_2": "genres",
+    "question_3": "era",
+    "question_4": "themes",
+    "question_5": "country",
+}
+
+
+def legacy_selected(question_key: str, answer: str) -> list[str]:
+    """
+    Строка старой анкеты -> тексты выбранных вариантов. По ", " не делим:
+    в самих вариантах бывают запятые ("Скандинавия (Швеция, Норвегия, Дания)")
+    """
+    padded = f", {answer or ''}, "
+    return [option for option in CALLBACK_IDS[question_key].values() if f", {option}, " in padded]
+
+
+def _migrate_anketa_answers(sync_conn) -> int:
+    """Переносит ответы из строковых колонок в маски и удаляет старые колонки"""
+    existing = {column['name'] for column in inspect(sync_conn).get_columns('users_anketa')}
+    legacy = {key: column for key, column in LEGACY_ANKETA_COLUMNS.items() if column in existing}
+    if not legacy:
+        return 0
+
+    rows = sync_conn.execute(text(f"SELECT user_id, {', '.join(legacy.values())} FROM users_anketa")).mappings().all()
+    for row in rows:
+        masks = {
+            ANKETA_FIELDS[key]: encode_selected(key, legacy_selected(key, row[column]))
+            for key, column in legacy.items()
+        }
+        assignments = ', '.join(f"{field} = :{field}" for field in masks)
+        sync_conn.execute(text(f"UPDATE users_anketa SET {assignments} WHERE user_id = :user_id"), {**masks, 'user_id': row['user_id']})
+
+    # Старые колонки NOT NULL без значения по умолчанию: пока они есть, новую анкету не вставить
+    for column in legacy.values():
+        sync_conn.execute(text(f"ALTER TABLE users_anketa DROP COLUMN {column}"))
+    return len(rows)
+
+
+async def upgrade_schema(conn: AsyncConnection):
+    """Доводит базу, созданную прошлой версией бота, до текущих моделей. Повторный запуск ничего не меняет"""
+    added = await conn.run_sync(_add_missing_columns)
+    if added:
+        logger.info(f"Добавлены колонки: {', '.join(added)}")
+
+    migrated = await conn.run_sync(_migrate_anketa_answers)
+    if migrated:
+        logger.info(f"Ответы анкеты перенесены в битовые маски: {migrated} пользователей")
@@ -1,27 +1,41 @@
+import os
+import asyncio
 from aiogram import types
+from aiogram.exceptions import TelegramRetryAfter
 import logging
-import aiohttp
-
-async def debug_image_url(url: str):
-    async with aiohttp.ClientSession() as session:
-        async with session.head(url) as resp:
-            print(f"URL: {url}")
-            print(f"Status: {resp.status}")
-            print(f"Content-Type: {resp.content_type}")
+from database.engine import session_maker
+from database.orm_query import save_movie_poster_file_id
+from utils.rate_limiter import get_limiter
+from utils.posters import choose_poster, poster_is_fresh
+from utils.ttl_cache import TTLCache, MISSING
 
 logger = logging.getLogger(__name__)
 
     
-async def is_url_valid(url: str) -> bool:
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.head(url, timeout=3) as response:
-                return response.status == 200
-    except Exception:
-        return False
+telegram_limiter = get_limiter('telegram')
+NO_POSTER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Images", "NoImage.png")
+FILE_ID_TTL = 30 * 24 * 3600
+FILE_ID_CACHE_SIZE = 5000
 
+# file_id уже загруженных в Telegram картинок: URL постера (или путь к заглушке) -> file_id.
+# Повторная отправка по file_id не заставляет Telegram заново скачивать постер
+poster_file_ids = TTLCache(maxsize=FILE_ID_CACHE_SIZE)
+# Что последним записали в базу: IMDb ID -> file_id
+saved_file_ids = TTLCache(maxsize=FILE_ID_CACHE_SIZE)
+_file_id_tasks = set()
 
 
+async def telegram_call(method, *args, **kwargs):
+    """Вызов Bot API через общий ограничитель; на flood control ждём столько, сколько просит Telegram"""
+    for attempt in range(telegram_limiter.max_retries + 1):
+        await telegram_limiter.acquire()
+        try:
+            return await method(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt == telegram_limiter.max_retries:
+                raise
+            logger.warning(f"Telegram просит подождать {e.retry_after} с")
+            telegram_limiter.penalize(e.retry_after)
 
 
 async def send_movie_card(message: types.Message, movie, index: int, edit: bool = False, custom_keyboard=None) -> types.Message:
@@ -37,6 +51,7 @@ async def send_movie_card(message: types.Message, movie, index: int, edit: bool
         duration = movie.get('duration', 'Неизвестно')
         genres = movie.get('genres', 'Неизвестно')
         description = movie.get('description', 'Описание отсутствует')
+        valid_poster = movie.get('valid_poster')
         logger.info(f"ИЗ СЛОВАРЯ: poster {poster_url}, ombd poster {omdb_poster}")
     else:
         logger.info(f"Текущий фильм: {movie.movie_name}")
@@ -50,14 +65,13 @@ async def send_movie_card(message: types.Message, movie, index: int, edit: bool
         duration = movie.movie_duration
         genres = movie.movie_genre
         description = movie.movie_description
+        valid_poster = movie.movie_valid_poster if poster_is_fresh(movie.movie_poster_checked_at) else None
         logger.info(f"ИЗ БАЗЫ ДАННЫХ: poster {poster_url}, ombd poster {omdb_poster}")
 
-    # 💡 Проверка постера
-    for fallback_url in [poster_url, omdb_poster]:
-        
-        if fallback_url and await is_url_valid(fallback_url):
-            poster_url = fallback_url
-            break
+    # 💡 Постер проверяется при сохранении фильма; на лету проверяем только ещё не проверенные
+    if valid_poster is None:
+        valid_poster = await choose_poster(poster_url, omdb_poster)
+    poster_url = valid_poster or NO_POSTER_PATH
 
     movie_text = (
         f"<b>Название:</b> {title}\n"
@@ -68,28 +82,100 @@ async def send_movie_card(message: types.Message, movie, index: int, edit: bool
         f"<b>Описание:</b> {description}\n"
         f'<a href="{google_search_url}">🎬 Смотреть</a>'
     )
-    try:
-        if edit:
-            msg = await message.edit_media(
-                types.InputMediaPhoto(
-                    media=poster_url,
-                    caption=movie_text,
-                    parse_mode="HTML",
-                ),
-                reply_markup=custom_keyboard(index)
-            )
-        else:
-            msg = await message.answer_photo(
-                photo=poster_url,
-                caption=movie_text,
-                reply_markup=custom_keyboard(index)
-            )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке карточки фильма: {e}")
-        msg = await message.answer_photo(
-            photo="https://i.imgur.com/RwD6GYr.png",
-            caption=movie_text,
-            reply_markup=custom_keyboard(index)
+    reply_markup = custom_keyboard(index)
+    imdb = movie.get('movie_id') if isinstance(movie, dict) else movie.imdb
+    # file_id из базы годится, только если он от того же постера, который отправляем сейчас
+    stored_file_id = None
+    if not isinstance(movie, dict) and movie.movie_valid_poster == valid_poster:
+        stored_file_id = movie.movie_poster_file_id
+    file_id = poster_file_ids.get(poster_url)
+    if file_id is MISSING:
+        file_id = stored_file_id
+
+    msg = None
+    if file_id:
+        try:
+            msg = await _send_photo(message, file_id, movie_text, reply_markup, edit)
+        except Exception as e:
+            # file_id мог устареть (другой бот, удалённый файл) - забываем его и грузим постер заново
+            logger.warning(f"Не удалось отправить постер по file_id, загружаем заново: {e}")
+            poster_file_ids.pop(poster_url)
+            file_id = None
+
+    if msg is None:
+        try:
+            msg = await _send_photo(message, _photo_input(poster_url), movie_text, reply_markup, edit)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке карточки фильма: {e}")
+            poster_url = NO_POSTER_PATH
+            fallback_id = poster_file_ids.get(NO_POSTER_PATH)
+            photo = fallback_id if fallback_id is not MISSING else _photo_input(NO_POSTER_PATH)
+            msg = await telegram_call(message.answer_photo, photo=photo, caption=movie_text, reply_markup=reply_markup)
+
+    uploaded = not file_id
+    if uploaded:
+        # Картинку загружали заново - запоминаем file_id, который выдал Telegram
+        file_id = _sent_file_id(msg)
+        if file_id:
+            poster_file_ids.set(poster_url, file_id, ttl=FILE_ID_TTL)
+    # В базе file_id постера фильма; None - если сам постер отправить не удалось.
+    # Для карточек-словарей, где file_id из базы не виден, пишем только после новой загрузки
+    movie_file_id = file_id if poster_url != NO_POSTER_PATH else None
+    if movie_file_id != stored_file_id and (uploaded or not isinstance(movie, dict)):
+        # file_id из памяти, который уже записан в базу, второй раз не пишем
+        if uploaded or saved_file_ids.get(imdb) != movie_file_id:
+            _remember_file_id(imdb, movie_file_id)
+        if not isinstance(movie, dict):
+            # Объект фильма живёт в состоянии карусели: без этого каждый показ снова писал бы в базу
+            movie.movie_poster_file_id = movie_file_id
+
+    return msg
+
+
+def _photo_input(poster: str):
+    # Заглушка лежит в репозитории, постеры Telegram скачивает сам по URL
+    return types.FSInputFile(poster) if poster == NO_POSTER_PATH else poster
+
+
+async def _send_photo(message: types.Message, photo, caption: str, reply_markup, edit: bool):
+    if edit:
+        return await telegram_call(
+            message.edit_media,
+            types.InputMediaPhoto(
+                media=photo,
+                caption=caption,
+                parse_mode="HTML",
+            ),
+            reply_markup=reply_markup
         )
+    return await telegram_call(
+        message.answer_photo,
+        photo=photo,
+        caption=caption,
+        reply_markup=reply_markup
+    )
+
+
+def _sent_file_id(msg) -> str | None:
+    # edit_media для inline-сообщений возвращает True, а не сообщение
+    if isinstance(msg, types.Message) and msg.photo:
+        return msg.photo[-1].file_id
+    return None
 
-    return msg
\ No newline at end of file
+
+def _remember_file_id(imdb: str | None, file_id: str | None):
+    """Сохраняет (или сбрасывает) file_id постера фильма в фоне, не задерживая ответ пользователю"""
+    if not imdb:
+        return
+    task = asyncio.create_task(_save_file_id(imdb, file_id))
+    _file_id_tasks.add(task)
+    task.add_done_callback(_file_id_tasks.discard)
+
+
+async def _save_file_id(imdb: str, file_id: str | None):
+    try:
+        async with session_maker() as session:
+            await save_movie_poster_file_id(imdb, file_id, session)
+        saved_file_ids.set(imdb, file_id, ttl=FILE_ID_TTL)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить file_id постера {imdb}: {e}")
@@ -7,14 +7,23 @@ from aiogram.fsm.state import State, StatesGroup
 import logging
 from handlers.callback_data import Menu_Callback
 import os
+import time
 import asyncio
+import itertools
 
-from database.orm_query import add_movies_by_interaction, get_movies_by_interaction, check_recommendations_status, delete_movies_by_interaction
+from database.orm_query import add_movies_by_interaction, check_recommendations_status, get_unseen_movies_from_catalog, get_movies_from_db_by_imdb_list
+from database.orm_query import enqueue_candidates, pop_candidates
 from kbds.inline import get_callback_btns, subscribe_button, rate_buttons
-from chat_gpt.ai import get_movie_recommendation_by_interaction, get_movie_recommendation_by_search
-from kinopoisk_imdb.search import get_movies, extract_movie_data
+from chat_gpt.ai import get_movie_recommendation_by_interaction, get_movie_recommendation_by_search, get_seen_imdb_ids
+from kinopoisk_imdb.search import stream_movies, prefetch_omdb_record, resolved_imdb_ids
+from chat_gpt.search_cache import search_cache, is_title_query
+from database.fulltext import search_movies_fulltext
 from kbds.pagination import create_movie_carousel_keyboard
 from handlers.movie_utils import send_movie_card
+from utils.circuit_breaker import ProviderUnavailableError
+from utils.prefetch import Prefetcher
+from utils.usage import usage_tracker, BudgetExceededError
+from database.engine import session_maker
 recommendations_router = Router()
 
 
@@ -65,22 +74,20 @@ async def process_search_query(message: types.Message, state: FSMContext, sessio
     user_text = message.text
     user_id = message.from_user.id
     user_message_id = message.message_id
-    max_retries = 3
-    retries = 0
+    first_movie = None
     if (user_text):
         await bot.send_chat_action(message.chat.id, action="typing")
         await asyncio.sleep(1)
 
-        chat_gpt_response = await get_movie_recommendation_by_search(user_id, user_text, session)
-
-        if chat_gpt_response:
-            movies_data = await get_movies(chat_gpt_response, user_id, session)
-            movies = await extract_movie_data(movies_data)
+        stream = search_stream(user_id, user_text, session)
+        try:
+            first_movie = await anext(stream, None)
+        except ProviderUnavailableError as e:
+            logger.warning(f"Поиск по запросу недоступен: {e}")
 
-            retries += 1
-        if retries >= max_retries: 
+        if first_movie is None:
             await message.answer('Кажется, произошла ошибка или прогер хочет денег :(\nПопробуйте нажать кнопку "Стоп" и возобновить рекомендации или обратитесь в поддержку - @Ddasmii')
-            await message.answer()
+            await state.clear()
             return
         await asyncio.sleep(3)
         try:
@@ -115,18 +122,8 @@ async def process_search_query(message: types.Message, state: FSMContext, sessio
 
 
 
-        # Отправляем первый фильм
-        message = await send_movie_card(message, movies[0], 0, custom_keyboard=create_movie_carousel_keyboard)
-
-        # Сохраняем список фильмов, текущий индекс и ID сообщения в состояние
-        await state.set_state(Recomendations.waiting_for_action)
-        await state.update_data(
-            movies=movies,
-            current_index=0,
-            message_id=message.message_id,
-            chat_id=message.chat.id,
-            custom_query=True
-        )
+        # Отправляем первый фильм, остальные допишутся в состояние в фоне
+        await start_carousel(stream, first_movie, message, state, custom_query=True)
 
 
 
@@ -139,6 +136,242 @@ async def safe_callback_answer(callback: CallbackQuery, text: str = None, show_a
         logger.warning(f"⚠️ Ошибка при callback.answer(): {e}")
 
 
+MAX_RECOMMENDATION_RETRIES = 3
+QUEUE_BATCH_SIZE = 20     # сколько фильмов за раз забираем из очереди кандидатов
+MORE_MOVIES_TIMEOUT = 15  # секунд ждём следующую карточку, если пользователь долистал до конца, а поток ещё идёт
+
+# Фоновые задачи, дописывающие карточки в карусель: stream_id -> задача (ещё и ссылки от сборщика мусора)
+_stream_tasks: dict[int, asyncio.Task] = {}
+_stream_ids = itertools.count(1)
+
+
+async def search_stream(user_id: int, text: str, session: AsyncSession):
+    """
+    Фильмы по свободному запросу потоком: название ищем в локальном каталоге, затем общий кэш поиска,
+    и только если для пользователя там ничего нет - GPT. Сессия обработчика нужна только до первой карточки
+    """
+    seen_imdb_ids = await get_seen_imdb_ids(user_id, session)
+    if is_title_query(text):
+        found = await search_movies_fulltext(text, session)
+        movies = [movie for movie in found if movie.imdb not in seen_imdb_ids]
+        logger.info(f"Локальный поиск по названию '{text}': {len(movies)} фильмов")
+        if movies:
+            for movie in movies:
+                yield movie
+            return
+
+    movies = []
+    cached_ids = await search_cache.get(text)
+    if cached_ids:
+        by_imdb = await get_movies_from_db_by_imdb_list([imdb for imdb in cached_ids if imdb not in seen_imdb_ids], session)
+        movies = [by_imdb[imdb] for imdb in cached_ids if imdb in by_imdb]
+    search_cache.record(hit=bool(movies))
+    logger.info(f"Кэш поиска: {search_cache.stats()}")
+    if movies:
+        for movie in movies:
+            yield movie
+        return
+
+    if usage_tracker.exhausted('omdb'):
+        raise BudgetExceededError("Суточный бюджет omdb исчерпан, а в кэше поиска ничего нет")
+    chat_gpt_response = await get_movie_recommendation_by_search(user_id, text, session, on_title=prefetch_omdb_record)
+    if not chat_gpt_response:
+        return
+    async for movie in stream_movies(chat_gpt_response, user_id, session):
+        yield movie
+    # Запрос к GPT не зависит от истории пользователя, поэтому в общий кэш кладём все разрешённые названия,
+    # включая уже просмотренные этим пользователем - другим они пригодятся
+    await search_cache.add(text, resolved_imdb_ids(chat_gpt_response))
+
+
+async def queued_stream(user_id: int, session: AsyncSession):
+    """То, что уже ждёт в очереди кандидатов: остаток карусели после "Стоп" и сохранённые подготовленные порции"""
+    queued = await pop_candidates(user_id, session, limit=QUEUE_BATCH_SIZE)
+    if queued:
+        logger.info(f"Рекомендации из очереди кандидатов: {len(queued)} фильмов")
+    for movie in queued:
+        yield movie
+
+
+async def recommendation_stream(user_id: int, session: AsyncSession, state: FSMContext | None = None, fsm_data: dict | None = None):
+    """
+    Новая порция рекомендаций потоком; если GPT, OMDb или Кинопоиск недоступны - фильмы из локального каталога.
+    Первой идёт очередь кандидатов пользователя; повторы и каталог случаются только до первой карточки,
+    пока сессия обработчика ещё открыта.
+    fsm_data - фоновая подготовка по снимку состояния: очередь не трогаем (её забирают, только когда показывают),
+    а флаг приоритета анкеты не сбрасываем
+    """
+    if fsm_data is None:
+        found = False
+        async for movie in queued_stream(user_id, session):
+            found = True
+            yield movie
+        if found:
+            return
+
+    # Без OMDb новые названия от GPT не разрешить: не платим за запрос к GPT, сразу идём в локальный каталог
+    attempts = MAX_RECOMMENDATION_RETRIES
+    if usage_tracker.exhausted('omdb'):
+        logger.warning("Суточный бюджет OMDb исчерпан, берём фильмы из локального каталога")
+        attempts = 0
+
+    # Названия, которые не удалось показать: следующий запрос попросит GPT их не повторять
+    failed_titles = []
+    for attempt in range(attempts):
+        found = 0
+        try:
+            # Названия начинаем искать в OMDb, пока GPT дописывает остальные
+            chat_gpt_response = await get_movie_recommendation_by_interaction(
+                user_id, session, state=state, on_title=prefetch_omdb_record, failed_titles=failed_titles, fsm_data=fsm_data
+            )
+            async for movie in stream_movies(chat_gpt_response, user_id, session, failed_titles=failed_titles):
+                found += 1
+                yield movie
+        except ProviderUnavailableError as e:
+            logger.warning(f"{e}, берём фильмы из локального каталога")
+            break
+
+        if found:
+            return
+        logger.info(f"Попытка {attempt + 1}: новых фильмов не нашлось")
+
+    for movie in await get_unseen_movies_from_catalog(user_id, session):
+        yield movie
+
+
+async def prefetched_recommendations(user_id: int, fsm_data: dict):
+    # Фоновая порция живёт дольше обработчика, поэтому со своей сессией и со снимком состояния, а не с живым FSMContext
+    async with session_maker() as session:
+        async for movie in recommendation_stream(user_id, session, fsm_data=fsm_data):
+            yield movie
+
+
+# За сколько карточек до конца карусели начинаем готовить следующую порцию; env RECOMMENDATION_PREFETCH_AHEAD
+PREFETCH_AHEAD = int(os.getenv('RECOMMENDATION_PREFETCH_AHEAD', 3))
+recommendation_prefetcher = Prefetcher(
+    'Следующая порция',
+    prefetched_recommendations,
+    max_concurrent=int(os.getenv('RECOMMENDATION_PREFETCH_CONCURRENCY', 5)),
+)
+
+
+def movie_imdb_id(movie) -> str:
+    return movie.imdb if hasattr(movie, 'imdb') else movie.get('movie_id')
+
+
+async def maybe_prefetch(user_id: int, state: FSMContext):
+    """До конца карусели осталось PREFETCH_AHEAD карточек или меньше - готовим следующую порцию в фоне"""
+    data = await state.get_data()
+    if data.get('custom_query') or not data.get('stream_done', True):
+        return  # у своего запроса нет продолжения, а незавершённый поток ещё дописывает карусель
+    if len(data.get('movies', [])) - data.get('current_index', 0) <= PREFETCH_AHEAD:
+        recommendation_prefetcher.schedule(user_id, {'preferences_priority': data.get('preferences_priority', False)})
+
+
+async def without_movies(stream, imdb_ids: set):
+    # Порцию готовили заранее: пропускаем то, что пользователь успел оценить или ещё видит в карусели
+    async for movie in stream:
+        if movie_imdb_id(movie) not in imdb_ids:
+            yield movie
+
+
+async def start_carousel(stream, first_movie, message: types.Message, state: FSMContext, edit: bool = False, **extra):
+    """Показывает первую карточку и сохраняет карусель в состояние; остальные карточки поток дописывает в фоне"""
+    sent = await send_movie_card(message, first_movie, 0, edit=edit, custom_keyboard=create_movie_carousel_keyboard)
+
+    stream_id = next(_stream_ids)
+    await state.set_state(Recomendations.waiting_for_action)
+    await state.update_data(
+        movies=[first_movie],
+        current_index=0,
+        message_id=sent.message_id,
+        chat_id=sent.chat.id,
+        stream_id=stream_id,
+        stream_done=False,
+        **extra
+    )
+    task = asyncio.create_task(append_stream(stream, state, stream_id))
+    _stream_tasks[stream_id] = task
+    task.add_done_callback(lambda _: _stream_tasks.pop(stream_id, None))
+
+
+async def append_stream(stream, state: FSMContext, stream_id: int):
+    try:
+        async for movie in stream:
+            data = await state.get_data()
+            if data.get('stream_id') != stream_id:
+                # Карусель сменилась новой порцией: готовую карточку не выбрасываем, она уже стоила запросов
+                await enqueue_later(state.key.user_id, [movie])
+                break
+            await state.update_data(movies=data.get('movies', []) + [movie])
+    except Exception as e:
+        logger.warning(f"Поток карточек прервался: {e}")
+    finally:
+        await stream.aclose()
+        data = await state.get_data()
+        if data.get('stream_id') == stream_id:
+            await state.update_data(stream_done=True)
+            logger.info(f"Поток карточек завершён: {len(data.get('movies', []))} фильмов")
+            await maybe_prefetch(state.key.user_id, state)
+
+
+async def stop_stream(stream_id: int | None):
+    """Отменяет фоновый поток карусели и дожидается его: после этого список карточек в состоянии уже не изменится"""
+    task = _stream_tasks.pop(stream_id, None)
+    if task is not None and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def enqueue_later(user_id: int, movies: list):
+    # Поток живёт дольше обработчика, поэтому со своей сессией
+    try:
+        async with session_maker() as session:
+            await enqueue_candidates(user_id, [movie_imdb_id(movie) for movie in movies], session)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить карточки в очередь кандидатов: {e}")
+
+
+async def wait_for_movie(state: FSMContext, index: int, timeout: float = MORE_MOVIES_TIMEOUT) -> list:
+    """Пользователь долистал до конца, а поток ещё дописывает карточки: ждём карточку с номером index"""
+    deadline = time.monotonic() + timeout
+    while True:
+        data = await state.get_data()
+        movies = data.get('movies', [])
+        if index < len(movies) or data.get('stream_done', True) or time.monotonic() > deadline:
+            return movies
+        await asyncio.sleep(0.2)
+
+
+async def refill_recommendations(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
+    """
+    Карусель закончилась: показываем первую карточку из очереди кандидатов, заранее подготовленной порции
+    или новой порции - в таком порядке
+    """
+    user_id = callback.from_user.id
+    stream = queued_stream(user_id, session)
+    first_movie = await anext(stream, None)
+
+    prefetched = recommendation_prefetcher.take(user_id) if first_movie is None else None
+    if prefetched is not None:
+        data = await state.get_data()
+        shown = {movie_imdb_id(movie) for movie in data.get('movies', [])}
+        stream = without_movies(prefetched, shown | await get_seen_imdb_ids(user_id, session))
+        first_movie = await anext(stream, None)
+    logger.info(f"Подготовка порций: {recommendation_prefetcher.stats()}")
+
+    if first_movie is None:
+        stream = recommendation_stream(user_id, session, state)
+        first_movie = await anext(stream, None)
+    if first_movie is None:
+        await callback.message.answer('Кажется, произошла ошибка или прогер хочет денег :(\nПопробуйте нажать кнопку "Стоп" и возобновить рекомендации или обратитесь в поддержку - @Ddasmii')
+        await state.clear()
+        return
+
+    await start_carousel(stream, first_movie, callback.message, state, edit=True)
+    await safe_callback_answer(callback)
+
+
 
 @recommendations_router.callback_query(F.data == 'recommendations')
 async def send_recommendations(callback: CallbackQuery, session: AsyncSession, bot: Bot, state: FSMContext):
@@ -176,56 +409,17 @@ async def send_recommendations(callback: CallbackQuery, session: AsyncSession, b
         )
         return
     
-    unwatched_movies  = await get_movies_by_interaction(user_id, session,['unwatched'])
-
-    if unwatched_movies:
-
-        # Отправляем первый непросмотренный фильм
-        message = await send_movie_card(callback.message, unwatched_movies[0], 0, custom_keyboard=create_movie_carousel_keyboard)
-            
-            # Сохраняем список фильмов, текущий индекс и ID сообщения в состояние
-        await state.set_state(Recomendations.waiting_for_action)
-        await state.update_data(
-            movies=unwatched_movies, 
-            current_index=0,
-            message_id=message.message_id,
-            chat_id=message.chat.id
-        )
-        await delete_movies_by_interaction(user_id, session, ['unwatched'], unwatched_movies[0].imdb)
+    # Получаем фильмы потоком (сначала из очереди кандидатов): первая карточка показывается, как только готова
+    stream = recommendation_stream(user_id, session, state)
+    first_movie = await anext(stream, None)
+    if first_movie is None:
+        await callback.message.answer('Кажется, произошла ошибка или прогер хочет денег :(\nПопробуйте нажать кнопку "Стоп" и возобновить рекомендации или обратитесь в поддержку - @Ddasmii')
         await safe_callback_answer(callback)
-            
-
-    else:
-    # Получаем список фильмов
-        max_retries = 3
-        retries = 0
-        movies = []
-
-        while not movies and retries < max_retries:
-            chat_gpt_response = await get_movie_recommendation_by_interaction(user_id, session, state=state)
-            movies_data = await get_movies(chat_gpt_response, user_id, session)
-            movies = await extract_movie_data(movies_data)
-
-
-            retries += 1
-        if retries >= max_retries: 
-            await callback.message.answer('Кажется, произошла ошибка или прогер хочет денег :(\nПопробуйте нажать кнопку "Стоп" и возобновить рекомендации или обратитесь в поддержку - @Ddasmii')
-            await safe_callback_answer(callback)
-            return
-
-
-        # Отправляем первый фильм
-        message = await send_movie_card(callback.message, movies[0], 0, custom_keyboard=create_movie_carousel_keyboard)
+        return
 
-        # Сохраняем список фильмов, текущий индекс и ID сообщения в состояние
-        await state.set_state(Recomendations.waiting_for_action)
-        await state.update_data(
-            movies=movies,
-            current_index=0,
-            message_id=message.message_id,
-            chat_id=message.chat.id
-        )
-        await safe_callback_answer(callback)
+    # Отправляем первый фильм, остальные допишутся в состояние в фоне
+    await start_carousel(stream, first_movie, callback.message, state)
+    await safe_callback_answer(callback)
 
     
     
@@ -271,10 +465,15 @@ async def handle_movie_action(callback: CallbackQuery, callback_data: Menu_Callb
     
 
     if action == "stop_recommendations":
-        remaining_movies = movies[current_index:]
-        for movie in remaining_movies:
-            movie_id = movie.imdb if hasattr(movie, 'imdb') else movie.get('movie_id')
-            await add_movies_by_interaction(user_id, movie_id, 'unwatched', session)
+        # Останавливаем поток, чтобы он не дописывал карточки после того, как мы заберём остаток
+        await state.update_data(stream_id=None)
+        await stop_stream(data.get('stream_id'))
+        movies = (await state.get_data()).get('movies', [])
+
+        # Остаток карусели встаёт в начало очереди кандидатов, уже подготовленная порция - в конец
+        prepared = recommendation_prefetcher.cancel(user_id)
+        await enqueue_candidates(user_id, [movie_imdb_id(movie) for movie in movies[current_index:]], session, front=True)
+        await enqueue_candidates(user_id, [movie_imdb_id(movie) for movie in prepared], session)
 
         await bot.delete_message(chat_id=callback.message.chat.id, message_id=callback.message.message_id)
         await state.clear()
@@ -304,6 +503,9 @@ async def handle_movie_action(callback: CallbackQuery, callback_data: Menu_Callb
     
     current_index += 1
     await state.update_data(current_index=current_index)
+    await maybe_prefetch(user_id, state)
+    if current_index >= len(movies):
+        movies = await wait_for_movie(state, current_index)
 
     if current_index < len(movies):
         await send_movie_card(callback.message, movies[current_index], current_index, edit=True, custom_keyboard=create_movie_carousel_keyboard)
@@ -317,24 +519,7 @@ async def handle_movie_action(callback: CallbackQuery, callback_data: Menu_Callb
             return
         await safe_callback_answer(callback, "Подождите немного, подгружаем новые рекомендации...")
 
-        while True:
-            chat_gpt_response = await get_movie_recommendation_by_interaction(user_id, session, state=state)
-            movies_data = await get_movies(chat_gpt_response, user_id, session)
-            new_movies = await extract_movie_data(movies_data)
-            if new_movies:
-                message = await send_movie_card(callback.message, new_movies[0], 0, edit=True, custom_keyboard=create_movie_carousel_keyboard)
-
-                await state.set_state(Recomendations.waiting_for_action)
-                await state.update_data(
-                    movies=new_movies,
-                    current_index=0,
-                    message_id=message.message_id,
-                    chat_id=message.chat.id
-                )
-                await safe_callback_answer(callback)
-                return
-            
-            await safe_callback_answer(callback, "Не удалось получить рекомендации. Пробуем ещё раз...")
+        await refill_recommendations(callback, session, state)
         
 
 
@@ -359,6 +544,9 @@ async def handle_rating(callback: types.CallbackQuery, state: FSMContext, sessio
     await state.update_data(last_action="")
     current_index += 1
     await state.update_data(current_index=current_index)
+    await maybe_prefetch(user_id, state)
+    if current_index >= len(movies):
+        movies = await wait_for_movie(state, current_index)
 
     if current_index < len(movies):
         await send_movie_card(callback.message, movies[current_index], current_index, edit=True, custom_keyboard=create_movie_carousel_keyboard)
@@ -372,25 +560,7 @@ async def handle_rating(callback: types.CallbackQuery, state: FSMContext, sessio
             return
         await safe_callback_answer(callback, "Подождите немного, подгружаем новые рекомендации...")
 
-        while True:
-            chat_gpt_response = await get_movie_recommendation_by_interaction(user_id, session, state=state)
-            movies_data = await get_movies(chat_gpt_response, user_id, session)
-            new_movies = await extract_movie_data(movies_data)
-            
-            if new_movies:
-                message = await send_movie_card(callback.message, new_movies[0], 0, edit=True, custom_keyboard=create_movie_carousel_keyboard)
-
-                await state.set_state(Recomendations.waiting_for_action)
-                await state.update_data(
-                    movies=new_movies,
-                    current_index=0,
-                    message_id=message.message_id,
-                    chat_id=message.chat.id
-                )
-                await safe_callback_answer(callback)
-                return
-            
-            await safe_callback_answer(callback, "Не удалось получить рекомендации. Пробуем ещё раз...")
+        await refill_recommendations(callback, session, state)
 
     
 
@@ -0,0 +1,67 @@
+import json
+import logging
+from datetime import datetime, timedelta
+
+from database.engine import session_maker
+from database.orm_query import get_imdb_resolutions, save_imdb_resolution
+from utils.ttl_cache import TTLCache, MISSING
+from kinopoisk_imdb.title_match import normalize_title
+
+
+logger = logging.getLogger(__name__)
+
+
+POSITIVE_TTL = timedelta(days=30)   # найденный IMDb ID почти не меняется
+NEGATIVE_TTL = timedelta(days=1)    # "не найдено" перепроверяем чаще
+MEMORY_SIZE = 5000
+
+
+class ImdbResolutionCache:
+    """Кэш название -> запись OMDb: LRU в памяти + запись в таблицу imdb_resolution"""
+
+    def __init__(self, maxsize: int = MEMORY_SIZE):
+        self.memory = TTLCache(maxsize=maxsize)
+        self.db_hits = 0
+
+    def get(self, title: str):
+        """Возвращает запись OMDb, None (фильм точно не найден) или MISSING"""
+        return self.memory.get(normalize_title(title))
+
+    async def load(self, titles: list[str]):
+        """Одним запросом подгружает из базы ключи, которых нет в памяти"""
+        keys = {normalize_title(title) for title in titles}
+        keys = [key for key in keys if key not in self.memory]
+        if not keys:
+            return
+
+        try:
+            async with session_maker() as session:
+                rows = await get_imdb_resolutions(keys, session)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать кэш IMDb из базы: {e}")
+            return
+
+        for key, row in rows.items():
+            record = json.loads(row.omdb_data) if row.imdb_id and row.omdb_data else None
+            self.memory.set(key, record, ttl=0, expires_at=row.expires_at.timestamp())
+        self.db_hits += len(rows)
+
+    async def set(self, title: str, record: dict | None):
+        key = normalize_title(title)
+        ttl = POSITIVE_TTL if record else NEGATIVE_TTL
+        self.memory.set(key, record, ttl=ttl.total_seconds())
+
+        imdb_id = record['imdb_id'] if record else None
+        omdb_data = json.dumps(record, ensure_ascii=False) if record else None
+        try:
+            async with session_maker() as session:
+                await save_imdb_resolution(key, imdb_id, omdb_data, datetime.now() + ttl, session,
+                                           confidence=record.get('confidence') if record else None)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить '{key}' в кэш IMDb: {e}")
+
+    def stats(self) -> dict:
+        return {**self.memory.stats(), 'db_hits': self.db_hits}
+
+
+imdb_cache = ImdbResolutionCache()
@@ -1,13 +1,26 @@
-import aiohttp
 import os
 import asyncio
 from dotenv import load_dotenv
 import logging
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from sqlalchemy import select, update
-from database.models import Movies
-from database.orm_query import add_movie, get_movies_by_interaction, get_movie_from_db,  get_movies_from_db_by_imdb_list, add_omdb_poster_to_db
+from database.orm_query import add_movie, get_movies_by_interaction, get_movies_from_db_by_imdb_list
+from database.orm_query import get_unservable_imdb_ids, mark_unservable, get_expired_unservable, delete_unservable, update_movie_posters
+from database.orm_query import get_expired_omdb_only_ids, OMDB_ONLY_REASON
+from utils.http_client import get_http_session
+from utils.ttl_cache import MISSING
+from utils.singleflight import SingleFlight
+from utils.micro_batch import MicroBatcher
+from utils.rate_limiter import get_limiter, parse_retry_after, limiters_state, QuotaExceededError
+from utils.concurrency import get_concurrency, concurrency_state
+from utils.circuit_breaker import get_breaker, breakers_state, CircuitOpenError
+from utils.hedging import get_hedger, hedgers_state
+from utils.usage import usage_tracker, BudgetExceededError
+from utils.posters import choose_poster, poster_is_fresh
+from kinopoisk_imdb.imdb_cache import imdb_cache, normalize_title
+from kinopoisk_imdb.title_match import match_confidence, MIN_RESOLUTION_CONFIDENCE
+from database.engine import session_maker
+from chat_gpt.movie_output import split_title_year, original_title_for
 
 
 load_dotenv()
@@ -20,39 +33,133 @@ logger = logging.getLogger(__name__)
 API_KEY_OMDB = os.getenv('OMDB_API_KEY')
 API_KEY_KINOPOISK = os.getenv('KINOPOISK_API_KEY')
 
-imdb_cache = {}
+omdb_flight = SingleFlight('omdb')
+kinopoisk_flight = SingleFlight('kinopoisk')
 
-sem = asyncio.Semaphore(5)  
 
 
+async def safe_get_omdb_record(title: str) -> dict | None:
+    cached = imdb_cache.get(title)
+    if cached is not MISSING:
+        return cached
 
-async def safe_get_imdb_id(title: str) -> str | None:
-    if title in imdb_cache:
-        return imdb_cache[title]
+    # Одинаковые названия от разных пользователей ждут один запрос к OMDb
+    return await omdb_flight.do(normalize_title(title), _resolve_omdb_record, title)
 
-    async with sem:  # ограничим одновременные запросы
-        imdb_id = await get_imdb_id(title)
-        imdb_cache[title] = imdb_id
-        return imdb_id
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_prefetch_tasks = set()
 
-async def get_imdb_id(movie_title: str):
-    url = f'http://www.omdbapi.com/?t={movie_title}&apikey={API_KEY_OMDB}'
+
+def prefetch_omdb_record(title: str):
+    """
+    Запускает разрешение названия в фоне, пока GPT ещё дописывает список.
+    find_in_imbd потом получит результат из кэша или дождётся этого же запроса через omdb_flight
+    """
+    task = asyncio.ensure_future(_prefetch_omdb_record(title))
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
+
+
+async def _prefetch_omdb_record(title: str):
+    await imdb_cache.load([title])
+    await safe_get_omdb_record(title)
+
+
+async def _resolve_omdb_record(title: str) -> dict | None:
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.json()
-
-                if data['Response'] == 'True':
-                    return data['imdbID']
-                else:
-                    return None
+        record = await get_omdb_record(title)
     except Exception as e:
-        print(f"Error fetching IMDb ID for {movie_title}: {e}")
+        # Сетевые ошибки и лимиты OMDb не кэшируем, чтобы не запомнить ложный промах
+        logger.error(f"Не удалось получить IMDb ID для '{title}': {e}")
+        return None
+
+    await imdb_cache.set(title, record)
+    return record
+
+
+async def get_omdb_record(movie_title: str) -> dict | None:
+    """
+    Запись OMDb для названия от GPT. Название может нести год ("Dune (2021)") - тогда ищем с &y=,
+    а если с этим годом ничего нет (GPT ошибается на год-два) - без года и сверяем найденное сами.
+    Не нашлось или нашёлся другой фильм - повторяем по названию на языке оригинала из ответа GPT
+    """
+    title, year = split_title_year(movie_title)
+    record = await _find_omdb_record(title, year, movie_title, [title])
+    original = original_title_for(movie_title)
+    if record is None and original and normalize_title(original) != normalize_title(title):
+        logger.info(f"Ищем '{movie_title}' в OMDb по оригинальному названию '{original}'")
+        record = await _find_omdb_record(original, year, movie_title, [title, original], by_original=True)
+    return record
+
+
+async def _find_omdb_record(query: str, year: int | None, label: str, names: list[str], by_original: bool = False) -> dict | None:
+    data = await _query_omdb(query, label, year) if year else None
+    if data is None:
+        data = await _query_omdb(query, label)
+    if data is None:
+        return None
+
+    record = compact_omdb_record(data)
+    record['confidence'] = max(match_confidence(name, year, record) for name in names)
+    if by_original and year and record['year'] == year:
+        # По оригинальному названию OMDb отдаёт английское ("Le Fabuleux Destin..." -> "Amélie"), и названия
+        # не сравнить. Нашёлся фильм ровно того года, что назвал GPT, - этого достаточно
+        record['confidence'] = max(record['confidence'], MIN_RESOLUTION_CONFIDENCE)
+    if record['confidence'] < MIN_RESOLUTION_CONFIDENCE:
+        logger.warning(f"OMDb нашёл по '{label}' другой фильм: {record['title']} ({record['year']}), уверенность {record['confidence']}")
         return None
+    return record
 
 
+async def _query_omdb(title: str, label: str, year: int | None = None) -> dict | None:
+    url = 'http://www.omdbapi.com/'
+    params = {'t': title, 'apikey': API_KEY_OMDB}
+    if year:
+        params['y'] = year
+    data = await fetch_movie_data(url, label, get_http_session(), params=params, provider='omdb')
+    if data is None:
+        raise RuntimeError('OMDb не ответил')
+
+    if data['Response'] == 'True':
+        return data
+    if data.get('Error', '').endswith('not found!'):
+        return None
+    raise RuntimeError(data.get('Error', 'Unknown OMDb error'))
+
 
+def compact_omdb_record(data: dict) -> dict:
+    """Оставляет из ответа OMDb только то, что нужно дальше: ID, постер, год, жанры, рейтинг, длительность"""
+    def value(key):
+        field = data.get(key)
+        return None if field in (None, '', 'N/A') else field
+
+    year = value('Year')
+    rating = value('imdbRating')
+    return {
+        'imdb_id': data['imdbID'],
+        'title': value('Title'),
+        'year': int(year[:4]) if year and year[:4].isdigit() else None,
+        'poster': value('Poster') or '',
+        'genre': value('Genre'),
+        'imdb_rating': float(rating) if rating and rating.replace('.', '', 1).isdigit() else None,
+        'runtime': value('Runtime'),
+        'type': value('Type'),
+        'plot': value('Plot'),
+    }
+
+
+
+
+
+def resolved_imdb_ids(titles: list[str]) -> list[str]:
+    """IMDb ID уже разрешённых названий (из кэша, без запросов к OMDb) в порядке titles"""
+    imdb_ids = []
+    for title in titles:
+        record = imdb_cache.get(title)
+        if record and record is not MISSING:
+            imdb_ids.append(record['imdb_id'])
+    return list(dict.fromkeys(imdb_ids))
 
 
 async def find_in_imbd(movie_list: list, user_id: int, session: AsyncSession):
@@ -60,7 +167,7 @@ async def find_in_imbd(movie_list: list, user_id: int, session: AsyncSession):
         logger.warning("Получен пустой список фильмов")
         return {}
 
-    movie_imdb_ids = {}
+    movie_records = {}
 
     # Получаем список уже рекомендованных фильмов
     recommended_movies = await get_movies_by_interaction(
@@ -71,54 +178,229 @@ async def find_in_imbd(movie_list: list, user_id: int, session: AsyncSession):
     recommended_imdb_ids = {movie.imdb for movie in recommended_movies}
     #logger.info(f"ID рекомендованных фильмов: {recommended_imdb_ids}.\n")
 
-    # Формируем задачи
-    tasks = [safe_get_imdb_id(movie) for movie in movie_list]
-    imdb_ids = await asyncio.gather(*tasks)
+    # Подгружаем сохранённые результаты одним запросом, затем формируем задачи
+    await imdb_cache.load(movie_list)
+    tasks = [safe_get_omdb_record(movie) for movie in movie_list]
+    records = await asyncio.gather(*tasks)
+    logger.info(f"Кэш IMDb: {imdb_cache.stats()}, объединение запросов: {omdb_flight.stats()}")
+    logger.info(f"Ограничители запросов: {limiters_state()}, параллельность: {concurrency_state()}, предохранители: {breakers_state()}, хеджирование: {hedgers_state()}")
+    logger.info(f"Расход внешних сервисов: {usage_tracker.state()}")
 
     # Обрабатываем результаты
-    for movie, imdb_id in zip(movie_list, imdb_ids):
-        if imdb_id and imdb_id not in recommended_imdb_ids:
-            movie_imdb_ids[movie] = imdb_id
-
-    logger.info(f"финальный список фильмов после сортировки: {movie_imdb_ids}.")
-
-    return movie_imdb_ids
-
-
-
-async def fetch_movie_data(url, movie_title, session, retries=2):
+    for movie, record in zip(movie_list, records):
+        if record and record['imdb_id'] not in recommended_imdb_ids:
+            movie_records[movie] = record
+            recommended_imdb_ids.add(record['imdb_id'])  # разные названия одного фильма показываем один раз
+
+    logger.info(f"финальный список фильмов после сортировки: { {movie: record['imdb_id'] for movie, record in movie_records.items()} }.")
+
+    if not movie_records and get_breaker('omdb').is_open:
+        # Без OMDb новые названия не разрешить - пусть обработчик переходит на запасной источник
+        raise CircuitOpenError("omdb недоступен, а в кэше ничего не нашлось")
+
+    return movie_records
+
+
+
+async def fetch_movie_data(url, movie_title, session, params=None, retries=2, provider='kinopoisk'):
+    """
+    GET-запрос к внешнему сервису с ограничителями и предохранителем.
+    Возвращает JSON или None; если предохранитель разомкнут - бросает CircuitOpenError, не обращаясь к сервису
+    """
+    breaker = get_breaker(provider)
+    breaker.check()
+
+    fetch = lambda: _fetch_with_retries(url, movie_title, session, params, retries, provider)
+    if usage_tracker.soft_exceeded(provider):
+        # Бюджет на исходе: дубликаты запросов не запускаем
+        data, outcome = await fetch()
+    else:
+        # Если ответ задерживается дольше обычного, хеджер запускает дубликат и берёт первый удачный ответ
+        data, outcome = await get_hedger(provider).run(fetch, is_success=lambda result: result[1] == 'ok')
+    if outcome == 'failed':
+        breaker.record_failure()
+    elif outcome == 'skipped':
+        breaker.record_skipped()
+    else:
+        breaker.record_success()
+    return data
+
+
+async def _fetch_with_retries(url, movie_title, session, params, retries, provider):
+    """Возвращает (данные, исход): исход 'ok', 'client_error', 'skipped' или 'failed'"""
+    limiter = get_limiter(provider)
+    concurrency = get_concurrency(provider)  # число одновременных запросов подстраивается под задержки сервиса
     for attempt in range(retries + 1):
         try:
-            async with session.get(url) as response:
+            usage_tracker.check(provider)
+            await limiter.acquire()
+            async with concurrency.slot() as outcome, session.get(url, params=params) as response:
                 if response.status == 200:
-                    return await response.json()
+                    data = await response.json()
+                    usage_tracker.record(provider, bytes=len(await response.read()))
+                    return data, 'ok'
+                usage_tracker.record(provider, errors=1)
+                outcome.error = response.status == 429 or response.status >= 500
                 logger.error(f"[{attempt+1}] Ошибка запроса для {movie_title}: {response.status}")
+                if response.status == 429:
+                    # Следующий acquire() сам выдержит паузу из Retry-After
+                    limiter.penalize(parse_retry_after(response.headers.get('Retry-After')))
+                    continue
+                if response.status < 500:
+                    return None, 'client_error'  # ошибки клиента повтором не исправить
+        except QuotaExceededError as e:
+            logger.warning(f"{e}, пропускаем {movie_title}")
+            return None, 'skipped'
         except asyncio.TimeoutError:
+            usage_tracker.record(provider, errors=1)
             logger.warning(f"[{attempt+1}] Таймаут для {movie_title}")
         except Exception as e:
+            usage_tracker.record(provider, errors=1)
             logger.error(f"[{attempt+1}] Ошибка при получении {movie_title}: {e}")
-        await asyncio.sleep(1)  # Короткая пауза
+        if attempt < retries:
+            await asyncio.sleep(limiter.backoff(attempt))
+    return None, 'failed'
+
+
+KINOPOISK_URL = 'https://api.kinopoisk.dev/v1.4/movie'
+KINOPOISK_BATCH_SIZE = 50
+# Только поля, которые используют extract_movie_data и add_movie (+ externalId для сопоставления)
+KINOPOISK_FIELDS = [
+    'externalId', 'name', 'shortDescription', 'description', 'rating', 'poster',
+    'year', 'genres', 'movieLength', 'seriesLength', 'type',
+]
+
+
+async def fetch_kinopoisk_batch(imdb_ids: list[str]) -> dict:
+    """
+    Один запрос к Кинопоиску на пачку IMDb ID (externalId.imdb=...&externalId.imdb=...).
+    Возвращает {imdb_id: doc или None, если фильма нет}; ID из упавших запросов в ответ не попадают
+    """
+    params = [('token', API_KEY_KINOPOISK), ('limit', len(imdb_ids))]
+    params += [('selectFields', field) for field in KINOPOISK_FIELDS]
+    params += [('externalId.imdb', imdb_id) for imdb_id in imdb_ids]
+
+    try:
+        data = await fetch_movie_data(KINOPOISK_URL, f"пачки из {len(imdb_ids)} фильмов", get_http_session(), params=params)
+    except CircuitOpenError as e:
+        logger.warning(f"{e}, карточки соберём из данных OMDb")
+        return {}
+    if not data or not isinstance(data.get('docs'), list):
+        return {}
+
+    docs_by_imdb = dict.fromkeys(imdb_ids)
+    for doc in data['docs']:
+        imdb_id = (doc.get('externalId') or {}).get('imdb')
+        if imdb_id in docs_by_imdb and docs_by_imdb[imdb_id] is None:
+            docs_by_imdb[imdb_id] = doc
+    return docs_by_imdb
+
+
+async def fetch_kinopoisk_docs(imdb_ids: list[str]) -> dict:
+    # Большие списки режем на пачки и запрашиваем параллельно
+    chunks = [imdb_ids[i:i + KINOPOISK_BATCH_SIZE] for i in range(0, len(imdb_ids), KINOPOISK_BATCH_SIZE)]
+    results = await asyncio.gather(*(fetch_kinopoisk_batch(chunk) for chunk in chunks))
+
+    docs_by_imdb = {}
+    for result in results:
+        docs_by_imdb.update(result)
+    return docs_by_imdb
+
+
+# Фильмы из потоковой выдачи доходят до Кинопоиска по одному - склеиваем их в общие пачки
+kinopoisk_batcher = MicroBatcher('kinopoisk', fetch_kinopoisk_docs, max_size=KINOPOISK_BATCH_SIZE)
+
+
+async def shared_fetch_kinopoisk_docs(imdb_ids: list[str]) -> dict:
+    # IMDb ID, которые уже запрашивает другой пользователь, ждут его ответ
+    return await kinopoisk_flight.do_many(imdb_ids, kinopoisk_batcher.load_many)
+
+def kinopoisk_doc_problem(doc: dict | None, label: str) -> str | None:
+    """Причина, по которой документ Кинопоиска не годится для карточки, или None"""
+    if not doc:
+        logger.warning(f"❌ Кинопоиск не знает фильм {label}")
+        return 'not_found'
+
+    if not doc.get('name') or not doc.get('poster', {}).get('url') or not doc.get('rating', {}).get('kp') or not (doc.get('shortDescription') or doc.get('description')):
+        logger.warning(f"⚠️ Недостаточно данных для {label}:")
+        logger.warning(f" - name: {doc.get('name')}")
+        logger.warning(f" - poster: {doc.get('poster', {}).get('url')}")
+        logger.warning(f" - rating.kp: {doc.get('rating', {}).get('kp')}")
+        logger.warning(f" - shortDescription: {doc.get('shortDescription')}")
+        logger.warning(f" - description: {doc.get('description')}")
+        return 'incomplete'
+
     return None
 
 
-semaphore = asyncio.Semaphore(5)
-async def limited_fetch(url, movie_title, session):
-    async with semaphore:
-        return await fetch_movie_data(url, movie_title, session)
+def omdb_only_doc(record: dict) -> dict | None:
+    """Документ в формате Кинопоиска из записи OMDb - запасной вариант, когда Кинопоиск недоступен"""
+    if not record.get('title') or not record.get('poster'):
+        return None
 
-timeout = aiohttp.ClientTimeout(total=5)
-async def find_in_kinopoisk_by_imdb(movie_imdb_ids, session: AsyncSession):
+    runtime = (record.get('runtime') or '').split(' ')[0]
+    return {
+        'externalId': {'imdb': record['imdb_id']},
+        'name': record['title'],
+        'shortDescription': record.get('plot') or 'Описание недоступно',
+        'rating': {'kp': record.get('imdb_rating') or 0.0},
+        'poster': {'url': record['poster']},
+        'year': record.get('year') or 0,
+        'genres': [{'name': genre.strip()} for genre in (record.get('genre') or '').split(',') if genre.strip()],
+        'movieLength': int(runtime) if runtime.isdigit() else None,
+        'type': 'tv-series' if record.get('type') == 'series' else 'movie',
+    }
+
+
+async def _mark_unservable(imdb_id: str, reason: str, omdb_poster: str, session: AsyncSession):
+    try:
+        await mark_unservable(imdb_id, reason, session, movie_omdb_poster=omdb_poster)
+    except Exception as e:
+        logger.error(f"❌ Не удалось запомнить {imdb_id} как недоступный на Кинопоиске: {e}")
+
+
+async def save_kinopoisk_doc(imdb_id: str, movie_info: dict, omdb_poster: str, session: AsyncSession, valid_poster: str | None = None):
+    movie_length = movie_info.get('movieLength')
+    series_length = movie_info.get('seriesLength')
+    duration = f"{movie_length or series_length or 0} min"
+    movie_type = movie_info.get('type') or "movie"
+
+    try:
+        await add_movie(
+            movie_id=imdb_id,
+            movie_name=movie_info.get('name', ''),
+            movie_description=movie_info.get('shortDescription') or movie_info.get('description', ''),
+            movie_rating=movie_info.get('rating', {}).get('kp', 0.0),
+            movie_poster=movie_info.get('poster', {}).get('url', ''),
+            movie_year=movie_info.get('year', 0),
+            movie_genre=', '.join([genre['name'] for genre in movie_info.get('genres', [])]),
+            movie_duration=duration,
+            movie_type=movie_type,
+            session=session,
+            movie_omdb_poster=omdb_poster,
+            movie_valid_poster=valid_poster
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка при добавлении фильма {imdb_id} в БД: {e}")
+        await session.rollback()
+
+
+async def find_in_kinopoisk_by_imdb(movie_records, session: AsyncSession):
+    """Принимает {название: запись OMDb} из find_in_imbd и дополняет её данными Кинопоиска"""
     movies_data = {}
     movies_to_fetch = {}
 
     # Проверяем локальную базу
-    valid_imdb_ids = [imdb for imdb in movie_imdb_ids.values() if imdb != 'Not Found']
+    valid_imdb_ids = [record['imdb_id'] for record in movie_records.values()]
     movies_from_db = await get_movies_from_db_by_imdb_list(valid_imdb_ids, session)
-
-    for movie, imdb_id in movie_imdb_ids.items():
-        if imdb_id == 'Not Found':
-            continue
-
+    # Карточки, собранные только по OMDb во время сбоя Кинопоиска, при первой возможности собираем заново
+    refetch = await get_expired_omdb_only_ids(list(movies_from_db), session)
+    if refetch:
+        logger.info(f"Перезапрашиваем у Кинопоиска карточки, собранные по OMDb: {refetch}")
+        movies_from_db = {imdb_id: movie for imdb_id, movie in movies_from_db.items() if imdb_id not in refetch}
+
+    for movie, record in movie_records.items():
+        imdb_id = record['imdb_id']
         movie_from_db = movies_from_db.get(imdb_id)
         if movie_from_db:
             omdb_poster = movie_from_db.movie_omdb_poster
@@ -126,6 +408,7 @@ async def find_in_kinopoisk_by_imdb(movie_imdb_ids, session: AsyncSession):
             movies_data[movie] = {
                 'imdb_id': imdb_id,
                 'omdb_poster': omdb_poster,
+                'omdb': record,
                 'data': {
                     'docs': [{
                         'name': movie_from_db.movie_name,
@@ -140,85 +423,186 @@ async def find_in_kinopoisk_by_imdb(movie_imdb_ids, session: AsyncSession):
                 }
             }
         else:
-            movies_to_fetch[movie] = imdb_id
+            movies_to_fetch[movie] = record
+
+    # Постеры фильмов из базы перепроверяем, только если прошлая проверка устарела
+    stale = {
+        imdb_id: movie_from_db for imdb_id, movie_from_db in movies_from_db.items()
+        if not poster_is_fresh(movie_from_db.movie_poster_checked_at)
+    }
+    if stale:
+        posters = await asyncio.gather(*(choose_poster(m.movie_poster, m.movie_omdb_poster) for m in stale.values()))
+        rechecked = dict(zip(stale, posters))
+        try:
+            await update_movie_posters(rechecked, session)
+        except Exception as e:
+            logger.error(f"❌ Не удалось сохранить проверку постеров: {e}")
+        for data in movies_data.values():
+            if data['imdb_id'] in rechecked:
+                data['valid_poster'] = rechecked[data['imdb_id']]
+    for data in movies_data.values():
+        data.setdefault('valid_poster', movies_from_db[data['imdb_id']].movie_valid_poster)
+
+    # IMDb ID, которые Кинопоиск недавно не смог отдать, в сеть не отправляем
+    if movies_to_fetch:
+        unservable = await get_unservable_imdb_ids([record['imdb_id'] for record in movies_to_fetch.values()], session)
+        if unservable:
+            logger.info(f"Пропускаем фильмы без данных на Кинопоиске: {unservable}")
+            movies_to_fetch = {movie: record for movie, record in movies_to_fetch.items() if record['imdb_id'] not in unservable}
 
-    # Обращаемся к API Кинопоиска
+    # Обращаемся к API Кинопоиска одним пакетным запросом
     if movies_to_fetch:
-        async with aiohttp.ClientSession(timeout=timeout) as session_http:
-            tasks = [
-                limited_fetch(
-                    f'https://api.kinopoisk.dev/v1.4/movie?externalId.imdb={imdb_id}&token={API_KEY_KINOPOISK}',
-                    movie,
-                    session_http
-                )
-                for movie, imdb_id in movies_to_fetch.items()
-            ]
-            movie_data_list = await asyncio.gather(*tasks)
-
-            for data, (movie, imdb_id) in zip(movie_data_list, movies_to_fetch.items()):
-                if not data:
-                    logger.warning(f"❌ Нет данных от API для '{movie}' (imdb: {imdb_id})")
-                    continue
+        docs_by_imdb = await shared_fetch_kinopoisk_docs([record['imdb_id'] for record in movies_to_fetch.values()])
+
+        to_save = []  # (название, IMDb ID, запись OMDb, документ, собран ли только по OMDb)
+        for movie, record in movies_to_fetch.items():
+            imdb_id = record['imdb_id']
+            omdb_poster = record.get('poster', '')
+            if imdb_id not in docs_by_imdb:
+                logger.warning(f"❌ Нет данных от API для '{movie}' (imdb: {imdb_id})")
+                doc = omdb_only_doc(record)
+                if doc:
+                    # Кинопоиск не ответил: показываем карточку по данным OMDb, а перепроверка позже заменит её
+                    to_save.append((movie, imdb_id, record, doc, True))
+                continue
+
+            doc = docs_by_imdb[imdb_id]
+            problem = kinopoisk_doc_problem(doc, f"'{movie}' (imdb: {imdb_id})")
+            if problem:
+                await _mark_unservable(imdb_id, problem, omdb_poster, session)
+                continue
+            to_save.append((movie, imdb_id, record, doc, False))
+
+        # Постеры проверяем один раз при сохранении: все фильмы и оба кандидата параллельно
+        posters = await asyncio.gather(*(
+            choose_poster(doc.get('poster', {}).get('url'), record.get('poster', '')) for _, _, record, doc, _ in to_save
+        ))
+
+        for (movie, imdb_id, record, doc, omdb_only), valid_poster in zip(to_save, posters):
+            omdb_poster = record.get('poster', '')
+            # Сохраняем в результирующий словарь и в базу данных
+            movies_data[movie] = {
+                'imdb_id': imdb_id, 'omdb_poster': omdb_poster, 'omdb': record,
+                'valid_poster': valid_poster, 'data': {'docs': [doc]},
+            }
+            await save_kinopoisk_doc(imdb_id, doc, omdb_poster, session, valid_poster=valid_poster)
+            if omdb_only:
+                await _mark_unservable(imdb_id, OMDB_ONLY_REASON, omdb_poster, session)
+            elif imdb_id in refetch:
+                try:
+                    await delete_unservable(imdb_id, session)
+                except Exception as e:
+                    logger.error(f"❌ Не удалось снять отметку omdb_only с {imdb_id}: {e}")
 
-                docs = data.get("docs")
-                if not docs or not isinstance(docs, list) or not docs:
-                    logger.warning(f"❌ Пустой или неверный формат 'docs' от API для '{movie}' (imdb: {imdb_id}). Ответ: {data}")
-                    continue
+    return movies_data
 
-                doc = docs[0]
-                if not doc.get('name') or not doc.get('poster', {}).get('url') or not doc.get('rating', {}).get('kp') or not (doc.get('shortDescription') or doc.get('description')):
-                    logger.warning(f"⚠️ Недостаточно данных для '{movie}' (imdb: {imdb_id}):")
-                    logger.warning(f" - name: {doc.get('name')}")
-                    logger.warning(f" - poster: {doc.get('poster', {}).get('url')}")
-                    logger.warning(f" - rating.kp: {doc.get('rating', {}).get('kp')}")
-                    logger.warning(f" - shortDescription: {doc.get('shortDescription')}")
-                    logger.warning(f" - description: {doc.get('description')}")
-                    continue
+UNSERVABLE_SWEEP_INTERVAL = 6 * 60 * 60  # секунд между перепроверками
 
-                movie_info = doc
-                movie_length = movie_info.get('movieLength')
-                series_length = movie_info.get('seriesLength')
-                duration = f"{movie_length or series_length or 0} min"
-                movie_type = movie_info.get('type') or "movie"
 
-                # Сохраняем в результирующий словарь
-                movies_data[movie] = {'imdb_id': imdb_id, 'data': data}
+async def sweep_unservable(session: AsyncSession) -> int:
+    """Перепроверяет на Кинопоиске фильмы, у которых истёк retry_after. Возвращает число восстановленных"""
+    expired = await get_expired_unservable(session)
+    if not expired:
+        return 0
 
-                # Сохраняем в базу данных
-                try:
-                    await add_movie(
-                        movie_id=imdb_id,
-                        movie_name=movie_info.get('name', ''),
-                        movie_description=movie_info.get('shortDescription') or movie_info.get('description', ''),
-                        movie_rating=movie_info.get('rating', {}).get('kp', 0.0),
-                        movie_poster=movie_info.get('poster', {}).get('url', ''),
-                        movie_year=movie_info.get('year', 0),
-                        movie_genre=', '.join([genre['name'] for genre in movie_info.get('genres', [])]),
-                        movie_duration=duration,
-                        movie_type=movie_type,
-                        session=session,
-                        movie_omdb_poster=""
-                    )
-                    omdb_poster = await add_omdb_poster_to_db(imdb_id, session)
-                    movies_data[movie] = {
-                        'imdb_id': imdb_id,
-                        'omdb_poster': omdb_poster, 
-                        'data': data
-                    }
+    posters = {row.imdb: row.movie_omdb_poster or "" for row in expired}
+    docs_by_imdb = await shared_fetch_kinopoisk_docs(list(posters))
 
+    restored = 0
+    for imdb_id, omdb_poster in posters.items():
+        if imdb_id not in docs_by_imdb:
+            continue  # запрос не удался - попробуем в следующий раз
 
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при добавлении фильма '{movie}' в БД: {e}")
-                    await session.rollback()
+        doc = docs_by_imdb[imdb_id]
+        problem = kinopoisk_doc_problem(doc, f"(imdb: {imdb_id})")
+        if problem:
+            await _mark_unservable(imdb_id, problem, omdb_poster, session)
+            continue
+
+        valid_poster = await choose_poster(doc.get('poster', {}).get('url'), omdb_poster)
+        await save_kinopoisk_doc(imdb_id, doc, omdb_poster, session, valid_poster=valid_poster)
+        await delete_unservable(imdb_id, session)
+        restored += 1
+
+    logger.info(f"Перепроверка Кинопоиска: {len(expired)} фильмов, восстановлено {restored}")
+    return restored
+
+
+async def run_unservable_sweeper(session_pool, interval: int = UNSERVABLE_SWEEP_INTERVAL):
+    while True:
+        try:
+            async with session_pool() as session:
+                await sweep_unservable(session)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при перепроверке фильмов Кинопоиска: {e}")
+        await asyncio.sleep(interval)
 
-    return movies_data
 
 async def get_movies(movies_list, user_id, session: AsyncSession):
-    movie_imdb_ids = await find_in_imbd(movies_list, user_id, session)
-    movies_data = await find_in_kinopoisk_by_imdb(movie_imdb_ids, session)
+    movie_records = await find_in_imbd(movies_list, user_id, session)
+    movies_data = await find_in_kinopoisk_by_imdb(movie_records, session)
     return movies_data
 
 
+async def _stream_item(title: str, seen_imdb_ids: set) -> tuple[str, dict | None]:
+    """Один фильм целиком: OMDb -> Кинопоиск -> база -> карточка. Возвращает (название, карточка или None)"""
+    try:
+        record = await safe_get_omdb_record(title)
+        if not record or record['imdb_id'] in seen_imdb_ids:
+            return title, None
+        # Своя сессия: фильмы обрабатываются параллельно и дольше, чем живёт сессия обработчика
+        async with session_maker() as session:
+            movies_data = await find_in_kinopoisk_by_imdb({title: record}, session)
+        cards = await extract_movie_data(movies_data)
+        return title, cards[0] if cards else None
+    except Exception as e:
+        logger.error(f"❌ Не удалось подготовить карточку для '{title}': {e}")
+        return title, None
+
+
+async def stream_movies(movies_list: list, user_id: int, session: AsyncSession, failed_titles: list | None = None):
+    """
+    Потоковый вариант get_movies + extract_movie_data: каждое название проходит весь путь само по себе,
+    и карточки отдаются по мере готовности - первая не ждёт самого медленного фильма.
+    Названия, по которым карточки не получилось, дописываются в failed_titles
+    """
+    if not movies_list:
+        logger.warning("Получен пустой список фильмов")
+        return
+
+    recommended_movies = await get_movies_by_interaction(
+        user_id=user_id, session=session,
+        interaction_types=['liked', 'disliked', 'skipped', 'watched']
+    )
+    seen_imdb_ids = {movie.imdb for movie in recommended_movies}
+    await imdb_cache.load(movies_list)
+
+    tasks = [asyncio.ensure_future(_stream_item(title, seen_imdb_ids)) for title in movies_list]
+    shown = set()
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            title, card = await next_done
+            # разные названия одного фильма показываем один раз
+            if card is None or card['movie_id'] in shown:
+                if failed_titles is not None:
+                    failed_titles.append(title)
+                continue
+            shown.add(card['movie_id'])
+            yield card
+    finally:
+        for task in tasks:
+            task.cancel()
+        logger.info(f"Поток карточек: {len(shown)} из {len(movies_list)}, кэш IMDb: {imdb_cache.stats()}, пачки Кинопоиска: {kinopoisk_batcher.stats()}")
+
+    if not shown and get_breaker('omdb').is_open:
+        # Без OMDb новые названия не разрешить - пусть обработчик переходит на запасной источник
+        raise CircuitOpenError("omdb недоступен, а в кэше ничего не нашлось")
+    if not shown and usage_tracker.exhausted('omdb'):
+        raise BudgetExceededError("Суточный бюджет omdb исчерпан, а в кэше ничего не нашлось")
+
+
 
 async def extract_movie_data(movies_data):
     movie_info_list = [] 
@@ -260,6 +644,7 @@ async def extract_movie_data(movies_data):
                 'year': year,
                 'poster': poster_url,
                 'omdb_poster': data.get('omdb_poster', ''),
+                'valid_poster': data.get('valid_poster'),
                 'description': description,
                 'rating': rating,
                 'genres': genres,
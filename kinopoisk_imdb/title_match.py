@@ -0,0 +1,61 @@
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+
+_ARTICLES = ('the', 'a', 'an')
+_TRAILING_ARTICLE = re.compile(r'^(.*),\s*(the|a|an)$')
+
+# Ниже этой уверенности найденная OMDb запись считается другим фильмом
+MIN_RESOLUTION_CONFIDENCE = 0.5
+# Совпадение по словам поднимаем до 0.9, только если общая часть не короче этого:
+# иначе "It" совпадёт с "It Follows", а "Up" - с "Up in the Air"
+MIN_BOOST_CHARS = 4
+# Посимвольное сходство засчитываем только для опечаток ("Interstelar" / "Interstellar"),
+# на коротких названиях оно высокое и у разных фильмов ("Her" / "Mother")
+TYPO_RATIO = 0.85
+
+
+def normalize_title(title: str) -> str:
+    """Приводит название к ключу кэша: "The Matrix", "the matrix" и "Matrix, The" -> "matrix" """
+    text = unicodedata.normalize('NFKC', title).casefold().strip()
+
+    match = _TRAILING_ARTICLE.match(text)
+    if match:
+        text = f"{match.group(2)} {match.group(1)}"
+
+    words = re.sub(r'[^\w\s]', ' ', text).split()
+    if len(words) > 1 and words[0] in _ARTICLES:
+        words = words[1:]
+    return ' '.join(words)
+
+
+def _title_score(wanted: str, found: str) -> float:
+    wanted_words, found_words = wanted.split(), found.split()
+    if not wanted_words or not found_words:
+        return 0.0
+
+    # Сходство по целым словам, взвешенное длиной слов: "Her" не часть слова "Mother"
+    blocks = SequenceMatcher(None, wanted_words, found_words, autojunk=False).get_matching_blocks()
+    matched = sum(len(word) for block in blocks for word in wanted_words[block.a:block.a + block.size])
+    total = sum(map(len, wanted_words)) + sum(map(len, found_words))
+    score = 2 * matched / total
+
+    # Одно название - начало другого по словам: "Star Wars" и "Star Wars: Episode IV - A New Hope"
+    shorter, longer = sorted((wanted_words, found_words), key=len)
+    if longer[:len(shorter)] == shorter and sum(map(len, shorter)) >= MIN_BOOST_CHARS:
+        score = max(score, 0.9)
+
+    ratio = SequenceMatcher(None, wanted, found).ratio()
+    return max(score, ratio) if ratio >= TYPO_RATIO else score
+
+
+def match_confidence(title: str, year: int | None, record: dict) -> float:
+    """Насколько найденная запись похожа на запрошенный фильм: сходство названий, умноженное на близость года"""
+    title_score = _title_score(normalize_title(title), normalize_title(record.get('title') or ''))
+
+    if not year or not record.get('year'):
+        year_score = 0.9
+    else:
+        year_score = {0: 1.0, 1: 0.9, 2: 0.7}.get(abs(year - record['year']), 0.3)
+    return round(title_score * year_score, 2)
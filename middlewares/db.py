@@ -4,6 +4,7 @@ from sqlalchemy.ext.asyncio import async_sessionmaker
 from typing import Any, Awaitable, Callable, Dict
 import os
 from kbds.inline import get_callback_btns, subscribe_button
+from utils.usage import current_handler, current_user
  
 
 
@@ -63,3 +64,23 @@ class CheckUserSubscription(BaseMiddleware):
         except Exception as e:
             print(f"Ошибка при проверке подписки: {e}")
             return await handler(event, data)
+
+
+class UsageContext(BaseMiddleware):
+    """Подписывает обращения к внешним сервисам именем обработчика и пользователя (см. utils/usage.py)"""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get('handler')
+        user = data.get('event_from_user')
+        handler_token = current_handler.set(getattr(handler_object.callback, '__name__', 'unknown') if handler_object else 'unknown')
+        user_token = current_user.set(user.id if user else 0)
+        try:
+            return await handler(event, data)
+        finally:
+            current_handler.reset(handler_token)
+            current_user.reset(user_token)
@@ -0,0 +1,71 @@
+"""
+Офлайн-подготовка кандидатов для самых частых комбинаций ответов анкеты.
+
+Для каждой комбинации один раз спрашиваем GPT, разрешаем названия через OMDb и Кинопоиск
+(фильмы сохраняются в movies, IMDb ID - в imdb_resolution) и записываем пул в anketa_candidates.
+Первая выдача рекомендаций по такой анкете потом собирается целиком из базы.
+
+    python precompute_candidates.py --top 50 --rounds 2
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from dotenv import find_dotenv, load_dotenv
+load_dotenv(find_dotenv())
+
+from database.engine import create_db, session_maker
+from database.orm_query import get_top_anketa_combinations, save_candidate_pool
+from chat_gpt.ai import build_preferences_messages, request_movie_titles
+from chat_gpt.anketa_mask import answers_key
+from chat_gpt.model_router import BATCH_ROUTE
+from kinopoisk_imdb.search import get_movies
+from utils.http_client import init_http_session, close_http_session
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Служебный пользователь без истории: find_in_imbd ничего не отфильтрует как просмотренное
+PRECOMPUTE_USER_ID = 0
+
+
+async def build_pool(combination, rounds: int, session) -> list[dict]:
+    messages = build_preferences_messages(combination)
+    candidates = {}
+    for _ in range(rounds):
+        titles = await request_movie_titles(messages, route=BATCH_ROUTE)
+        movies_data = await get_movies(titles, PRECOMPUTE_USER_ID, session)
+        for title, data in movies_data.items():
+            candidates.setdefault(data['imdb_id'], title)
+    return [{'title': title, 'imdb_id': imdb_id} for imdb_id, title in candidates.items()]
+
+
+async def main(top: int, rounds: int):
+    await create_db()
+    await init_http_session()
+    try:
+        async with session_maker() as session:
+            combinations = await get_top_anketa_combinations(session, limit=top)
+            logger.info(f"Комбинаций ответов для подготовки: {len(combinations)}")
+
+            for combination in combinations:
+                key = answers_key(combination)
+                try:
+                    pool = await build_pool(combination, rounds, session)
+                except Exception as e:
+                    logger.error(f"Не удалось подготовить кандидатов для {key}: {e}")
+                    continue
+                await save_candidate_pool(key, json.dumps(pool, ensure_ascii=False), combination.users_count, session)
+                logger.info(f"{key}: {len(pool)} фильмов, пользователей с такой анкетой: {combination.users_count}")
+    finally:
+        await close_http_session()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=50, help="сколько самых частых комбинаций подготовить")
+    parser.add_argument('--rounds', type=int, default=2, help="сколько раз спрашивать GPT на одну комбинацию")
+    args = parser.parse_args()
+    asyncio.run(main(args.top, args.rounds))
@@ -0,0 +1,32 @@
+import pytest
+
+from kinopoisk_imdb.title_match import match_confidence, MIN_RESOLUTION_CONFIDENCE
+
+
+@pytest.mark.parametrize('wanted, found', [
+    ("Her", "Mother"),
+    ("Up", "Upgrade"),
+    ("It", "It Follows"),
+    ("Up", "Up in the Air"),
+    ("Heat", "Death"),
+])
+def test_other_film_is_rejected(wanted, found):
+    assert match_confidence(wanted, None, {'title': found, 'year': None}) < MIN_RESOLUTION_CONFIDENCE
+
+
+@pytest.mark.parametrize('wanted, found', [
+    ("Her", "Her"),
+    ("Up", "Up"),
+    ("It", "It"),
+    ("The Matrix", "Matrix, The"),
+    ("Star Wars", "Star Wars: Episode IV - A New Hope"),
+    ("Interstelar", "Interstellar"),
+])
+def test_same_film_is_accepted(wanted, found):
+    assert match_confidence(wanted, None, {'title': found, 'year': None}) >= MIN_RESOLUTION_CONFIDENCE
+
+
+def test_year_lowers_confidence():
+    record = {'title': "Dune", 'year': 1984}
+    assert match_confidence("Dune", 2021, record) < MIN_RESOLUTION_CONFIDENCE
+    assert match_confidence("Dune", 1984, record) == 1.0
@@ -0,0 +1,86 @@
+import time
+
+
+class ProviderUnavailableError(Exception):
+    """Внешний сервис сейчас использовать нельзя - нужно идти в запасной источник"""
+
+
+class CircuitOpenError(ProviderUnavailableError):
+    """Предохранитель сервиса разомкнут"""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после failure_threshold подряд неудач сервис считается недоступным (open)
+    и запросы сразу отклоняются. Через reset_timeout пропускаем пробные запросы (half-open):
+    успех замыкает предохранитель, неудача снова размыкает его
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_probes: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.rejected = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def check(self):
+        """Вызывается перед запросом; бросает CircuitOpenError, если идти в сервис нельзя"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} недоступен, предохранитель разомкнут")
+            self.state = self.HALF_OPEN
+            self.probes_in_flight = 0
+
+        if self.state == self.HALF_OPEN:
+            if self.probes_in_flight >= self.half_open_probes:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} проверяется пробным запросом")
+            self.probes_in_flight += 1
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probes_in_flight = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probes_in_flight = 0
+
+    def record_skipped(self):
+        """Запрос не дошёл до сервиса (например, кончилась своя квота) - о его здоровье ничего не известно"""
+        if self.state == self.HALF_OPEN and self.probes_in_flight:
+            self.probes_in_flight -= 1
+
+    def stats(self) -> dict:
+        return {'state': self.state, 'failures': self.failures, 'rejected': self.rejected}
+
+
+BREAKERS = {
+    'omdb': CircuitBreaker('omdb'),
+    'kinopoisk': CircuitBreaker('kinopoisk'),
+    'openai': CircuitBreaker('openai', failure_threshold=3, reset_timeout=60.0),
+}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    return BREAKERS[name]
+
+
+def breakers_state() -> dict:
+    return {name: breaker.stats() for name, breaker in BREAKERS.items()}
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class _SlotOutcome:
+    def __init__(self):
+        self.error = False
+        self.cancelled = False
+
+
+class AdaptiveLimiter:
+    """
+    Адаптивный лимит одновременных запросов (AIMD).
+    Пока сглаженная задержка близка к базовой и ошибок нет, лимит растёт на 1 за "окно" запросов;
+    при ошибке или росте задержки выше baseline * tolerance лимит умножается на backoff_ratio
+    """
+
+    def __init__(self, name: str, initial: int = 5, min_limit: int = 1, max_limit: int = 50,
+                 tolerance: float = 2.0, backoff_ratio: float = 0.7, latency_window: int = 200):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff_ratio = backoff_ratio
+        self.in_flight = 0
+        self._waiters: deque = deque()
+        self._latencies: deque = deque(maxlen=latency_window)
+        self._smoothed = None
+        self._last_decrease = 0.0
+        self.errors = 0
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    async def acquire(self):
+        if self.in_flight < self.current_limit and not self._waiters:
+            self.in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()   # слот уже выдали, но задачу отменили
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.current_limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def release(self, latency: float, error: bool = False):
+        saturated = self.in_flight >= self.current_limit
+        self._update_limit(latency, error, saturated)
+        self._release_slot()
+
+    def _update_limit(self, latency: float, error: bool, saturated: bool):
+        if not error:
+            # Быстрые отказы не должны занижать базовую задержку
+            self._latencies.append(latency)
+            self._smoothed = latency if self._smoothed is None else self._smoothed * 0.8 + latency * 0.2
+        if not self._latencies:
+            return
+        # Базовая задержка без нагрузки - 10-й перцентиль последних успешных ответов
+        baseline = sorted(self._latencies)[len(self._latencies) // 10]
+
+        if error or self._smoothed > baseline * self.tolerance:
+            if error:
+                self.errors += 1
+            # Уменьшаем не чаще раза за типичное время ответа, чтобы одна пачка медленных ответов не обнулила лимит
+            now = time.monotonic()
+            if now - self._last_decrease >= self._smoothed:
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                self._last_decrease = now
+        elif saturated:
+            # Растём только когда лимит действительно упирается в нагрузку
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    @asynccontextmanager
+    async def slot(self):
+        """async with limiter.slot() as outcome: ...; outcome.error = True, если ответ плохой"""
+        await self.acquire()
+        outcome = _SlotOutcome()
+        started = time.monotonic()
+        try:
+            yield outcome
+        except asyncio.CancelledError:
+            outcome.cancelled = True
+            raise
+        except Exception:
+            outcome.error = True
+            raise
+        finally:
+            if outcome.cancelled:
+                # Отменённый запрос (например, проигравший хедж) ничего не говорит о задержке сервиса
+                self._release_slot()
+            else:
+                self.release(time.monotonic() - started, outcome.error)
+
+    def state(self) -> dict:
+        return {
+            'limit': self.current_limit,
+            'in_flight': self.in_flight,
+            'queue_depth': len(self._waiters),
+            'errors': self.errors,
+        }
+
+
+CONCURRENCY = {
+    'omdb': AdaptiveLimiter('omdb', initial=5, max_limit=30),
+    'kinopoisk': AdaptiveLimiter('kinopoisk', initial=5, max_limit=20),
+}
+
+
+def get_concurrency(name: str) -> AdaptiveLimiter:
+    return CONCURRENCY[name]
+
+
+def concurrency_state() -> dict:
+    return {name: limiter.state() for name, limiter in CONCURRENCY.items()}
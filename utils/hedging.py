@@ -0,0 +1,135 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+
+class LatencyTracker:
+    """Скользящее окно задержек успешных вызовов"""
+
+    def __init__(self, window: int = 500):
+        self._samples: deque = deque(maxlen=window)
+
+    def record(self, latency: float):
+        self._samples.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> float | None:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class Hedger:
+    """
+    Хеджирование запросов: если вызов не ответил за percentile-ю долю обычной задержки,
+    запускаем дубликат и берём первый удачный ответ. Дубликатов не больше budget от числа вызовов
+    """
+
+    def __init__(self, name: str, percentile: float = 0.95, budget: float = 0.1,
+                 min_samples: int = 20, min_delay: float = 0.05, enabled: bool = True):
+        self.name = name
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.enabled = enabled
+        self.latencies = LatencyTracker()
+        # Бюджет копится с каждым вызовом, каждый дубликат его тратит; запас на всплеск - 10 дубликатов
+        self.tokens = 0.0
+        self.max_tokens = 10.0
+        self.calls = 0
+        self.hedged = 0     # сколько раз запускали дубликат
+        self.hedge_won = 0  # сколько раз дубликат ответил первым
+
+    def hedge_delay(self) -> float | None:
+        """Через сколько секунд запускать дубликат; None - пока мало данных о задержках"""
+        if not self.enabled or len(self.latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, self.latencies.percentile(self.percentile))
+
+    def _take_token(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def run(self, fn, is_success=lambda result: True):
+        """
+        fn() - фабрика корутины (вызывается заново для дубликата).
+        Задержка записывается только для удачных ответов (is_success(result) == True)
+        """
+        self.calls += 1
+        self.tokens = min(self.max_tokens, self.tokens + self.budget)
+        started = time.monotonic()
+
+        delay = self.hedge_delay()
+        if delay is None:
+            # Без отдельной задачи: отмена вызывающего сразу отменяет и сам запрос
+            result = await fn()
+            if is_success(result):
+                self.latencies.record(time.monotonic() - started)
+            return result
+
+        primary = asyncio.ensure_future(fn())
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and self._take_token():
+                self.hedged += 1
+                pending.add(asyncio.ensure_future(fn()))
+
+            result = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if is_success(result):
+                        if task is not primary:
+                            self.hedge_won += 1
+                        self.latencies.record(time.monotonic() - started)
+                        return result
+            # Удачного ответа не было ни у одного вызова - возвращаем последний
+            return result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        p = self.latencies.percentile(self.percentile)
+        return {
+            'enabled': self.enabled,
+            'delay': round(p, 3) if p is not None else None,
+            'calls': self.calls,
+            'hedged': self.hedged,
+            'hedge_won': self.hedge_won,
+        }
+
+
+def _hedger_from_env(name: str, percentile: float, budget: float) -> Hedger:
+    prefix = f"HEDGE_{name.upper()}"
+    return Hedger(
+        name,
+        percentile=float(os.getenv(f"{prefix}_PERCENTILE", percentile)),
+        budget=float(os.getenv(f"{prefix}_BUDGET", budget)),
+        enabled=os.getenv(f"{prefix}_ENABLED", os.getenv('HEDGING_ENABLED', 'false')).lower() == 'true',
+    )
+
+
+# Хеджирование выключено по умолчанию: HEDGING_ENABLED=true или HEDGE_<ПРОВАЙДЕР>_ENABLED=true,
+# порог и бюджет - HEDGE_<ПРОВАЙДЕР>_PERCENTILE/_BUDGET
+HEDGERS = {
+    'omdb': _hedger_from_env('omdb', percentile=0.95, budget=0.1),
+    'kinopoisk': _hedger_from_env('kinopoisk', percentile=0.95, budget=0.05),
+}
+
+
+def get_hedger(name: str) -> Hedger:
+    return HEDGERS[name]
+
+
+def hedgers_state() -> dict:
+    return {name: hedger.stats() for name, hedger in HEDGERS.items()}
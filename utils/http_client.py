@@ -0,0 +1,54 @@
+import aiohttp
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Общие таймауты для всех внешних запросов (OMDb, Кинопоиск, постеры)
+timeout = aiohttp.ClientTimeout(total=5, connect=2, sock_read=4)
+
+# Ограничения пула соединений
+CONNECTIONS_LIMIT = 100         # всего открытых соединений
+CONNECTIONS_PER_HOST = 10       # соединений на один хост
+DNS_CACHE_TTL = 300             # секунд храним результаты DNS
+KEEPALIVE_TIMEOUT = 30          # секунд держим простаивающее соединение
+
+_http_session: aiohttp.ClientSession | None = None
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTIONS_LIMIT,
+        limit_per_host=CONNECTIONS_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        use_dns_cache=True,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+#функция для создания общей http-сессии при старте бота
+async def init_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = _create_session()
+        logger.info("HTTP-сессия создана")
+    return _http_session
+
+
+#функция для получения общей http-сессии (создаётся лениво, если бот не вызвал init)
+def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = _create_session()
+    return _http_session
+
+
+#функция для закрытия http-сессии при остановке бота
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+        logger.info("HTTP-сессия закрыта")
+    _http_session = None
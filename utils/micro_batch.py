@@ -0,0 +1,75 @@
+import asyncio
+
+from utils.singleflight import MISSING_KEY
+
+
+class MicroBatcher:
+    """
+    Склеивает ключи от одновременных вызовов в один пакетный запрос: первый ключ ждёт max_delay секунд
+    (или пока не наберётся max_size), затем fn(keys) -> {key: value} вызывается один раз для всей пачки.
+    Так фильмы, которые по отдельности доходят до Кинопоиска почти одновременно, уходят одним запросом
+    """
+
+    def __init__(self, name: str, fn, max_size: int = 50, max_delay: float = 0.02):
+        self.name = name
+        self.fn = fn
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._pending: dict = {}
+        self._timer = None
+        self._running = set()  # ссылки на задачи пачек, чтобы их не собрал сборщик мусора
+        self.batches = 0
+        self.keys = 0
+
+    async def load_many(self, keys) -> dict:
+        """Возвращает {key: value}; ключей, которых нет в ответе fn, в результате нет"""
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for key in dict.fromkeys(keys):
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = loop.create_future()
+            futures[key] = future
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._pending and self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+
+        # shield: отмена одного ожидающего не должна отменять ответ для остальных
+        results = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+        return {key: value for key, value in zip(futures, results) if value is not MISSING_KEY}
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        self.batches += 1
+        self.keys += len(batch)
+        task = asyncio.ensure_future(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: dict):
+        try:
+            result = await self.fn(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()  # ошибку получат ожидающие, остальным не нужно "never retrieved"
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(result.get(key, MISSING_KEY))
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'keys': self.keys,
+            'avg_batch': round(self.keys / self.batches, 2) if self.batches else 0.0,
+            'pending': len(self._pending),
+        }
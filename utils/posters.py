@@ -0,0 +1,37 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from utils.http_client import get_http_session
+from utils.singleflight import SingleFlight
+
+
+# Проверенный постер хранится в movies и перепроверяется не чаще, чем раз в POSTER_RECHECK_TTL
+POSTER_RECHECK_TTL = timedelta(days=7)
+
+poster_flight = SingleFlight('poster')
+
+
+async def is_url_valid(url: str) -> bool:
+    # Одновременные проверки одного постера делают один HEAD-запрос
+    return await poster_flight.do(url, _check_url, url)
+
+
+async def _check_url(url: str) -> bool:
+    try:
+        async with get_http_session().head(url, timeout=aiohttp.ClientTimeout(total=3)) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+
+async def choose_poster(*candidates: str) -> str:
+    """Первый рабочий постер по порядку кандидатов; проверяются все сразу. '' - рабочего нет"""
+    urls = [url for url in dict.fromkeys(candidates) if url]
+    results = await asyncio.gather(*(is_url_valid(url) for url in urls))
+    return next((url for url, valid in zip(urls, results) if valid), '')
+
+
+def poster_is_fresh(checked_at) -> bool:
+    return checked_at is not None and datetime.now() - checked_at < POSTER_RECHECK_TTL
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Prefetch:
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.changed = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.created_at = time.monotonic()
+
+
+class Prefetcher:
+    """
+    Фоновая подготовка следующей порции для пользователя: produce(user_id, *args) - асинхронный генератор.
+    Не больше одной задачи на пользователя, max_concurrent одновременно работающих задач,
+    max_items элементов в порции и max_users пользователей с подготовленными порциями; порция живёт ttl секунд
+    """
+
+    def __init__(self, name: str, produce, max_concurrent: int = 5, max_items: int = 20, max_users: int = 500, ttl: float = 900):
+        self.name = name
+        self.produce = produce
+        self.max_items = max_items
+        self.max_users = max_users
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._entries: OrderedDict[int, _Prefetch] = OrderedDict()
+        self.scheduled = 0
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0
+
+    def _expired(self, entry: _Prefetch) -> bool:
+        return time.monotonic() - entry.created_at > self.ttl
+
+    def schedule(self, user_id: int, *args):
+        """Запускает подготовку порции, если для пользователя её ещё нет"""
+        entry = self._entries.get(user_id)
+        if entry is not None and not self._expired(entry):
+            return
+        self.cancel(user_id, count=False)
+
+        while len(self._entries) >= self.max_users:
+            oldest = next(iter(self._entries))
+            self.cancel(oldest)
+
+        entry = _Prefetch()
+        entry.task = asyncio.create_task(self._run(entry, user_id, args))
+        self._entries[user_id] = entry
+        self.scheduled += 1
+        logger.info(f"{self.name}: готовим следующую порцию для {user_id}")
+
+    async def _run(self, entry: _Prefetch, user_id: int, args: tuple):
+        try:
+            async with self._semaphore:
+                stream = self.produce(user_id, *args)
+                try:
+                    async for item in stream:
+                        entry.items.append(item)
+                        entry.changed.set()
+                        if len(entry.items) >= self.max_items:
+                            break
+                finally:
+                    await stream.aclose()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"{self.name}: не удалось подготовить порцию для {user_id}: {e}")
+        finally:
+            entry.done = True
+            entry.changed.set()
+
+    def take(self, user_id: int):
+        """
+        Забирает подготовленную порцию: асинхронный генератор, который сразу отдаёт готовое
+        и дожидается остального, если подготовка ещё идёт. None - порции нет
+        """
+        entry = self._entries.pop(user_id, None)
+        if entry is None or self._expired(entry):
+            if entry is not None:
+                entry.task.cancel()
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._drain(entry)
+
+    async def _drain(self, entry: _Prefetch):
+        index = 0
+        try:
+            while True:
+                if index < len(entry.items):
+                    yield entry.items[index]
+                    index += 1
+                    continue
+                if entry.done:
+                    return
+                entry.changed.clear()
+                await entry.changed.wait()
+        finally:
+            entry.task.cancel()  # порцию дочитали или бросили - подготовка больше не нужна
+
+    def cancel(self, user_id: int, count: bool = True) -> list:
+        """Отменяет подготовку; возвращает уже готовые элементы, чтобы их можно было сохранить"""
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return []
+        entry.task.cancel()
+        if count:
+            self.cancelled += 1
+        return entry.items
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._entries),
+            'running': sum(1 for entry in self._entries.values() if not entry.done),
+            'scheduled': self.scheduled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'cancelled': self.cancelled,
+        }
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from utils.circuit_breaker import ProviderUnavailableError
+
+
+class QuotaExceededError(ProviderUnavailableError):
+    """Суточная квота провайдера исчерпана (считает utils/usage.py по записанному в базу расходу)"""
+
+
+class TokenBucket:
+    """Ограничение частоты: rate запросов в секунду, допускаются всплески до capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        # Лок выстраивает ожидающих в очередь, чтобы они не просыпались всей толпой
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class ProviderLimiter:
+    """
+    Ограничитель запросов к одному внешнему сервису: частота, Retry-After и паузы между повторами.
+    Суточный лимит - бюджет в utils/usage.py: он переживает перезапуск и считается в одном месте
+    """
+
+    def __init__(self, name: str, rate: float, burst: float,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 20.0):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.blocked_until = 0.0
+        self.throttled = 0      # сколько раз сервис ответил 429
+
+    async def acquire(self):
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.bucket.acquire()
+
+    def penalize(self, retry_after: float | None):
+        """Сервис попросил подождать: все запросы к нему ставим на паузу"""
+        self.throttled += 1
+        pause = retry_after if retry_after is not None else self.backoff_base
+        self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+
+    def backoff(self, attempt: int) -> float:
+        # Экспоненциальная пауза с джиттером, чтобы повторы не шли одновременно
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def state(self) -> dict:
+        self.bucket._refill()
+        return {
+            'tokens': round(self.bucket.tokens, 2),
+            'rate': self.bucket.rate,
+            'blocked_for': round(max(0.0, self.blocked_until - time.monotonic()), 2),
+            'throttled': self.throttled,
+        }
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After бывает числом секунд или HTTP-датой"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _limiter_from_env(name: str, rate: float, burst: float) -> ProviderLimiter:
+    prefix = f"RATE_LIMIT_{name.upper()}"
+    return ProviderLimiter(
+        name,
+        rate=float(os.getenv(f"{prefix}_RPS", rate)),
+        burst=float(os.getenv(f"{prefix}_BURST", burst)),
+    )
+
+
+# Настройки по умолчанию переопределяются переменными RATE_LIMIT_<ПРОВАЙДЕР>_RPS/_BURST;
+# суточные лимиты - USAGE_BUDGET_<ПРОВАЙДЕР>_SOFT/_HARD (utils/usage.py)
+LIMITERS = {
+    'omdb': _limiter_from_env('omdb', rate=10, burst=10),
+    'kinopoisk': _limiter_from_env('kinopoisk', rate=5, burst=5),
+    'openai': _limiter_from_env('openai', rate=2, burst=5),
+    'telegram': _limiter_from_env('telegram', rate=25, burst=30),
+}
+
+
+def get_limiter(name: str) -> ProviderLimiter:
+    return LIMITERS[name]
+
+
+def limiters_state() -> dict:
+    return {name: limiter.state() for name, limiter in LIMITERS.items()}
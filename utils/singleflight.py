@@ -0,0 +1,71 @@
+import asyncio
+
+
+# Ключ, которого нет в ответе пакетного запроса
+MISSING_KEY = object()
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые запросы: все вызовы с одним ключом ждут одну задачу"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict = {}
+        self.started = 0     # сколько раз действительно ушли во внешний сервис
+        self.shared = 0      # сколько вызовов дождались чужой результат
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+            self.started += 1
+        else:
+            self.shared += 1
+
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def do_many(self, keys, fn) -> dict:
+        """
+        Пакетный вариант do: fn(new_keys) -> {key: value} вызывается один раз для ключей,
+        которых ещё никто не запрашивает, остальные ключи ждут уже идущие запросы
+        """
+        waiting = {}
+        new_keys = []
+        for key in dict.fromkeys(keys):
+            task = self._calls.get(key)
+            if task is None:
+                new_keys.append(key)
+            else:
+                waiting[key] = task
+                self.shared += 1
+
+        if new_keys:
+            batch = asyncio.ensure_future(fn(new_keys))
+            self.started += 1
+            for key in new_keys:
+                task = asyncio.ensure_future(self._pick(batch, key))
+                self._calls[key] = task
+                task.add_done_callback(lambda done, key=key: self._forget(key, done))
+                waiting[key] = task
+
+        results = await asyncio.gather(*(asyncio.shield(task) for task in waiting.values()))
+        return {key: value for key, value in zip(waiting, results) if value is not MISSING_KEY}
+
+    @staticmethod
+    async def _pick(batch, key):
+        return (await batch).get(key, MISSING_KEY)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # помечаем исключение как полученное, чтобы не было "never retrieved"
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> dict:
+        return {'started': self.started, 'shared': self.shared, 'in_flight': len(self._calls)}
@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+
+# Маркер промаха: None в кэше - это валидное (отрицательное) значение
+MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш в памяти с ограниченным размером и своим сроком жизни у каждой записи"""
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return MISSING
+
+        value, expires_at = item
+        if expires_at <= time.time():
+            del self._data[key]
+            self.misses += 1
+            return MISSING
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float, expires_at: float | None = None):
+        self._data[key] = (value, expires_at if expires_at is not None else time.time() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[1] > time.time()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+        }
@@ -0,0 +1,169 @@
+import os
+import asyncio
+import logging
+import contextvars
+from collections import defaultdict
+from datetime import date
+
+from database.orm_query import add_api_usage, get_api_usage_totals
+from utils.rate_limiter import QuotaExceededError
+
+
+logger = logging.getLogger(__name__)
+
+
+# Кому записывать расход: ставит middleware UsageContext, фоновые задачи остаются 'background'
+current_handler = contextvars.ContextVar('usage_handler', default='background')
+current_user = contextvars.ContextVar('usage_user', default=0)
+
+COUNTERS = ('calls', 'errors', 'tokens', 'bytes')
+USAGE_FLUSH_INTERVAL = 60  # секунд между записями сводки в базу
+
+
+class BudgetExceededError(QuotaExceededError):
+    """Исчерпан жёсткий суточный бюджет на провайдера - дальше только кэш и локальный каталог"""
+
+
+class Budget:
+    """
+    Суточный бюджет провайдера в единицах unit ('calls' или 'tokens'); 0 - без ограничения.
+    После soft бот экономит (без хеджирования, с дешёвой моделью, охотнее берёт кэш),
+    после hard - вообще не обращается к провайдеру
+    """
+
+    def __init__(self, unit: str, soft: int = 0, hard: int = 0):
+        self.unit = unit
+        self.soft = soft
+        self.hard = hard
+
+
+class UsageTracker:
+    """Счётчики вызовов, токенов, байтов и ошибок по провайдерам, обработчикам и пользователям за текущие сутки"""
+
+    def __init__(self, budgets: dict[str, Budget]):
+        self.budgets = budgets
+        self.day = date.today()
+        self.totals = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))    # провайдер -> расход за сутки
+        self.pending = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))   # (день, провайдер, обработчик, пользователь) -> ещё не в базе
+        self.rejected = defaultdict(int)
+        self.soft_warned = set()
+
+    def _rollover(self):
+        today = date.today()
+        if today != self.day:
+            self.day = today
+            self.totals.clear()
+            self.rejected.clear()
+            self.soft_warned.clear()
+
+    def record(self, provider: str, calls: int = 1, errors: int = 0, tokens: int = 0, bytes: int = 0):
+        self._rollover()
+        delta = {'calls': calls, 'errors': errors, 'tokens': tokens, 'bytes': bytes}
+        pending = self.pending[(self.day, provider, current_handler.get(), current_user.get())]
+        for counter, value in delta.items():
+            self.totals[provider][counter] += value
+            pending[counter] += value
+
+        if self.soft_exceeded(provider) and provider not in self.soft_warned:
+            self.soft_warned.add(provider)
+            budget = self.budgets[provider]
+            logger.warning(f"{provider}: израсходовано {self.used(provider)} {budget.unit} из {budget.hard or '∞'}, переходим в режим экономии")
+
+    def used(self, provider: str) -> int:
+        self._rollover()
+        budget = self.budgets.get(provider)
+        return self.totals[provider][budget.unit] if budget else 0
+
+    def soft_exceeded(self, provider: str) -> bool:
+        budget = self.budgets.get(provider)
+        return bool(budget and budget.soft) and self.used(provider) >= budget.soft
+
+    def exhausted(self, provider: str) -> bool:
+        budget = self.budgets.get(provider)
+        return bool(budget and budget.hard) and self.used(provider) >= budget.hard
+
+    def check(self, provider: str):
+        """Вызывается перед обращением к провайдеру; бросает BudgetExceededError, если жёсткий бюджет исчерпан"""
+        if self.exhausted(provider):
+            budget = self.budgets[provider]
+            self.rejected[provider] += 1
+            raise BudgetExceededError(f"Суточный бюджет {provider} исчерпан ({budget.hard} {budget.unit})")
+
+    async def restore(self, session):
+        """Подхватывает уже записанный расход за сегодня, чтобы перезапуск бота не обнулял бюджеты"""
+        self._rollover()
+        totals = await get_api_usage_totals(self.day, session)
+        for provider, counters in totals.items():
+            for counter in COUNTERS:
+                self.totals[provider][counter] += counters[counter] or 0
+
+    async def flush(self, session):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        rows = [
+            {'day': day, 'provider': provider, 'handler': handler, 'user_id': user_id, **counters}
+            for (day, provider, handler, user_id), counters in pending.items()
+        ]
+        try:
+            await add_api_usage(rows, session)
+        except Exception:
+            # Не потеряем счётчики: вернём их к следующей записи
+            for key, counters in pending.items():
+                for counter, value in counters.items():
+                    self.pending[key][counter] += value
+            raise
+
+    def state(self) -> dict:
+        self._rollover()
+        state = {}
+        for provider, budget in self.budgets.items():
+            state[provider] = {
+                **self.totals[provider],
+                'budget': f"{self.used(provider)}/{budget.hard or '∞'} {budget.unit}",
+                'saving': self.soft_exceeded(provider),
+                'rejected': self.rejected[provider],
+            }
+        return state
+
+
+def _budget_from_env(name: str, unit: str, soft: int, hard: int) -> Budget:
+    prefix = f"USAGE_BUDGET_{name.upper()}"
+    return Budget(unit, soft=int(os.getenv(f"{prefix}_SOFT", soft)), hard=int(os.getenv(f"{prefix}_HARD", hard)))
+
+
+# Переопределяются переменными USAGE_BUDGET_<ПРОВАЙДЕР>_SOFT/_HARD.
+# OMDb: бесплатный ключ даёт 1000 запросов в сутки, останавливаемся чуть раньше
+usage_tracker = UsageTracker({
+    'omdb': _budget_from_env('omdb', 'calls', soft=800, hard=950),
+    'kinopoisk': _budget_from_env('kinopoisk', 'calls', soft=0, hard=0),
+    'openai': _budget_from_env('openai', 'tokens', soft=0, hard=0),
+})
+
+
+async def run_usage_flusher(session_pool, interval: int = USAGE_FLUSH_INTERVAL):
+    try:
+        async with session_pool() as session:
+            await usage_tracker.restore(session)
+    except Exception as e:
+        logger.error(f"Не удалось загрузить расход внешних сервисов за сегодня: {e}")
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with session_pool() as session:
+                await usage_tracker.flush(session)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Не удалось записать расход внешних сервисов: {e}")
+        logger.info(f"Расход внешних сервисов: {usage_tracker.state()}")
+
+
+async def flush_usage(session_pool):
+    """Последняя запись сводки при остановке бота"""
+    try:
+        async with session_pool() as session:
+            await usage_tracker.flush(session)
+    except Exception as e:
+        logger.error(f"Не удалось записать расход внешних сервисов: {e}")